@@ -9,7 +9,7 @@ from .loudness_norm import loudness_norm
 from .merge_short import merge_short
 from .resample import resample
 from .separate_audio import separate
-from .slice_audio import slice_audio, slice_audio_v2
+from .slice_audio import slice_audio, slice_audio_v2, slice_sweep
 from .transcribe import transcribe
 
 
@@ -32,6 +32,7 @@ cli.add_command(separate)
 cli.add_command(loudness_norm)
 cli.add_command(slice_audio)
 cli.add_command(slice_audio_v2)
+cli.add_command(slice_sweep)
 cli.add_command(resample)
 cli.add_command(transcribe)
 cli.add_command(merge_short)
@@ -1,13 +1,16 @@
+import json
+import os
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Optional
 
 import click
-import librosa
-import soundfile as sf
 from loguru import logger
 from tqdm import tqdm
 
 from fish_audio_preprocess.utils.file import AUDIO_EXTENSIONS, list_files
-from fish_audio_preprocess.utils.slice_audio_v2 import merge_short_chunks
+from fish_audio_preprocess.utils.resample import RESAMPLERS
 
 
 @click.command()
@@ -21,28 +24,115 @@ from fish_audio_preprocess.utils.slice_audio_v2 import merge_short_chunks
     show_default=True,
     type=int,
 )
-def merge_short(input_dir: str, output_dir: str, recursive: bool, max_duration: int):
-    """Merge short audio chunks into longer ones. Caution: This tool will scramble the filenames and this tool need files has same sample rate."""
+@click.option(
+    "--num-workers",
+    help="Number of workers to use for processing, defaults to number of CPU cores",
+    default=os.cpu_count(),
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--sampling-rate",
+    "-sr",
+    help="Resample every file to this rate while merging, "
+    "by default files are merged per rate, one subdirectory per rate",
+    default=None,
+    type=int,
+)
+@click.option(
+    "--resampler",
+    help="Resampling backend used with --sampling-rate",
+    default="soxr_hq",
+    show_default=True,
+    type=click.Choice(RESAMPLERS),
+)
+def merge_short(
+    input_dir: str,
+    output_dir: str,
+    recursive: bool,
+    max_duration: int,
+    num_workers: int,
+    sampling_rate: Optional[int],
+    resampler: str,
+):
+    """Merge short audio chunks into longer ones. Caution: This tool will scramble the filenames.
+
+    Durations are read from the file headers, the files are packed into outputs
+    of at most max duration (first-fit decreasing), and each output is written by
+    a worker, so memory does not grow with the number of files. merge_map.json in
+    the output directory lists the sources of each output.
+    """
+
+    from fish_audio_preprocess.utils.merge_short import (
+        merge_files,
+        pack_bins,
+        probe_audio,
+    )
 
     input_dir, output_dir = Path(input_dir), Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     files = list_files(input_dir, extensions=AUDIO_EXTENSIONS, recursive=recursive)
     logger.info(f"Found {len(files)} files")
 
-    audios = []
+    merge_map = {}
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # Only the headers are read, no file is decoded at this point
+        probes = list(
+            tqdm(
+                executor.map(probe_audio, files, chunksize=64),
+                total=len(files),
+                desc="Checking file",
+            )
+        )
+
+        rates = Counter(sr for _, sr, _ in probes)
+        logger.info(
+            "Sample rates: "
+            + ", ".join(
+                f"{sr} Hz ({count} files)" for sr, count in sorted(rates.items())
+            )
+        )
+
+        # Only files with the same rate and number of channels can be concatenated
+        groups = defaultdict(list)
+
+        for file, (length, sr, channels) in zip(files, probes):
+            if sampling_rate is not None and sr != sampling_rate:
+                length = round(length * sampling_rate / sr)
+
+            groups[sampling_rate or sr, channels].append((file, length))
+
+        logger.info("Start merging")
+        tasks = []
+
+        for (rate, channels), group in sorted(groups.items()):
+            bins = pack_bins([length for _, length in group], max_duration * rate)
+
+            # Outputs at different rates go to their own subdirectory
+            rate_dir = (
+                output_dir
+                if sampling_rate or len(rates) == 1
+                else output_dir / str(rate)
+            )
+            rate_dir.mkdir(parents=True, exist_ok=True)
+
+            for items in bins:
+                output_file = rate_dir / f"{len(merge_map)}.wav"
+                sources = [group[idx][0] for idx in items]
+                merge_map[str(output_file.relative_to(output_dir))] = [
+                    str(source.relative_to(input_dir)) for source in sources
+                ]
+                tasks.append(
+                    executor.submit(
+                        merge_files, sources, output_file, rate, channels, resampler
+                    )
+                )
 
-    rate = 0
-    # 遍历每个音频确定采样率是否一致
-    for file in tqdm(files, desc="Checking file"):
-        audio, sr = librosa.load(str(file), sr=None, mono=False)
-        if rate == 0:
-            rate = sr
-        if rate != sr:
-            raise ValueError(f"Sample rate of {file} is {sr}, not {rate}")
-        audios.append(audio)
+        for i in tqdm(as_completed(tasks), total=len(tasks), desc="Merging"):
+            assert i.exception() is None, i.exception()
 
-    logger.info("Start merging")
-    res = merge_short_chunks(audios, max_duration, rate)
+    with open(output_dir / "merge_map.json", "w", encoding="utf-8") as f:
+        json.dump(merge_map, f, ensure_ascii=False, indent=2)
 
-    for i, audio in enumerate(res):
-        sf.write(output_dir / f"{i}.wav", audio, rate)
+    logger.info(f"Merged {len(files)} files into {len(merge_map)} files")
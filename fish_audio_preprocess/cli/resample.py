@@ -1,4 +1,5 @@
 import os
+from collections import Counter
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
@@ -6,24 +7,90 @@ import click
 from loguru import logger
 from tqdm import tqdm
 
-from fish_audio_preprocess.utils.file import AUDIO_EXTENSIONS, list_files, make_dirs
+from fish_audio_preprocess.utils.file import (
+    AUDIO_EXTENSIONS,
+    LINK_MODES,
+    list_files,
+    make_dirs,
+)
+from fish_audio_preprocess.utils.resample import RESAMPLERS
 
 
 def resample_file(
-    input_file: Path, output_file: Path, overwrite: bool, samping_rate: int, mono: bool
-):
+    input_file: Path,
+    targets: dict[int, Path],
+    overwrite: bool,
+    mono: bool,
+    resampler: str = "soxr_hq",
+    streaming_threshold: float = -1,
+    link_mode: str = "reflink",
+) -> list[str]:
+    """Resample one file to every target rate, decoding it only once.
+
+    Returns the path (skipped, copy, reflink, hardlink, streamed or resampled)
+    taken by each target.
+    """
+
     import librosa
     import soundfile as sf
 
-    if overwrite is False and output_file.exists():
-        return
-
-    audio, _ = librosa.load(str(input_file), sr=samping_rate, mono=mono)
+    from fish_audio_preprocess.utils.file import link_or_copy
+    from fish_audio_preprocess.utils.resample import (
+        SOXR_QUALITIES,
+        is_target_format,
+        resample_audio,
+        resample_file_streaming,
+    )
+
+    paths = []
+    pending = {}
+
+    for target_sr, output_file in targets.items():
+        if overwrite is False and output_file.exists():
+            paths.append("skipped")
+        else:
+            pending[target_sr] = output_file
+
+    try:
+        info = sf.info(str(input_file))
+    except RuntimeError:
+        # Not readable by soundfile, let librosa decode it
+        info = None
+
+    if info is not None and link_mode != "off":
+        for target_sr, output_file in list(pending.items()):
+            if is_target_format(info, output_file, target_sr, mono):
+                paths.append(link_or_copy(input_file, output_file, link_mode))
+                del pending[target_sr]
+
+    if len(pending) == 0:
+        return paths
+
+    if (
+        info is not None
+        and resampler in SOXR_QUALITIES
+        and 0 <= streaming_threshold <= info.duration
+    ):
+        resample_file_streaming(input_file, pending, mono, resampler)
+        return paths + ["streamed"] * len(pending)
+
+    audio, sr = librosa.load(str(input_file), sr=None, mono=mono)
 
     if audio.ndim == 2:
         audio = audio.T
 
-    sf.write(str(output_file), audio, samping_rate)
+    # The decoded audio is shared by all target rates
+    for target_sr, output_file in pending.items():
+        # The output may be the input, or a hardlink to it from --link-mode
+        # hardlink, writing through it would modify the input
+        output_file.unlink(missing_ok=True)
+        sf.write(
+            str(output_file),
+            resample_audio(audio, sr, target_sr, resampler),
+            target_sr,
+        )
+
+    return paths + ["resampled"] * len(pending)
 
 
 @click.command()
@@ -46,9 +113,10 @@ def resample_file(
 @click.option(
     "--sampling-rate",
     "-sr",
-    help="Sampling rate to resample to",
-    default=44100,
+    help="Sampling rate to resample to, repeat to write every rate into its own subdirectory",
+    default=[44100],
     show_default=True,
+    multiple=True,
     type=int,
 )
 @click.option(
@@ -56,6 +124,27 @@ def resample_file(
     default=True,
     help="Resample to mono (1 channel)",
 )
+@click.option(
+    "--resampler",
+    help="Resampling backend, soxr_* are quality presets, integer is a fast path for integer ratios",
+    default="soxr_hq",
+    show_default=True,
+    type=click.Choice(RESAMPLERS),
+)
+@click.option(
+    "--streaming-threshold",
+    help="Stream files longer than this many seconds block by block to bound memory (soxr resamplers only), negative to disable",
+    default=600.0,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--link-mode",
+    help="How to reuse files already at the target rate, channels and subtype, off to always re-encode",
+    default="reflink",
+    show_default=True,
+    type=click.Choice([*LINK_MODES, "off"]),
+)
 def resample(
     input_dir: str,
     output_dir: str,
@@ -63,8 +152,11 @@ def resample(
     overwrite: bool,
     clean: bool,
     num_workers: int,
-    sampling_rate: int,
+    sampling_rate: list[int],
     mono: bool,
+    resampler: str,
+    streaming_threshold: float,
+    link_mode: str,
 ):
     """
     Resample all audio files in input_dir to output_dir.
@@ -79,9 +171,14 @@ def resample(
     make_dirs(output_dir, clean)
 
     files = list_files(input_dir, extensions=AUDIO_EXTENSIONS, recursive=recursive)
-    logger.info(f"Found {len(files)} files, resampling to {sampling_rate} Hz")
+    sampling_rate = sorted(set(sampling_rate))
+    logger.info(
+        f"Found {len(files)} files, resampling to "
+        f"{', '.join(map(str, sampling_rate))} Hz with {resampler}"
+    )
 
     skipped = 0
+    paths = Counter()
 
     with ProcessPoolExecutor(max_workers=num_workers) as executor:
         tasks = []
@@ -89,26 +186,43 @@ def resample(
         for file in tqdm(files, desc="Preparing tasks"):
             # Get relative path to input_dir
             relative_path = file.relative_to(input_dir)
-            new_file = output_dir / relative_path
+            targets = {
+                sr: (
+                    output_dir / relative_path
+                    if len(sampling_rate) == 1
+                    else output_dir / str(sr) / relative_path
+                )
+                for sr in sampling_rate
+            }
 
-            if new_file.parent.exists() is False:
-                new_file.parent.mkdir(parents=True)
+            for new_file in targets.values():
+                if new_file.parent.exists() is False:
+                    new_file.parent.mkdir(parents=True)
 
-            if new_file.exists() and not overwrite:
+            if not overwrite and all(f.exists() for f in targets.values()):
                 skipped += 1
                 continue
 
             tasks.append(
                 executor.submit(
-                    resample_file, file, new_file, overwrite, sampling_rate, mono
+                    resample_file,
+                    file,
+                    targets,
+                    overwrite,
+                    mono,
+                    resampler,
+                    streaming_threshold,
+                    link_mode,
                 )
             )
 
         for i in tqdm(as_completed(tasks), total=len(tasks), desc="Processing"):
             assert i.exception() is None, i.exception()
+            paths.update(i.result())
 
     logger.info("Done!")
     logger.info(f"Total: {len(files)}, Skipped: {skipped}")
+    logger.info(", ".join(f"{k.capitalize()}: {v}" for k, v in sorted(paths.items())))
     logger.info(f"Output directory: {output_dir}")
 
 
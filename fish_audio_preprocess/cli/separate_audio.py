@@ -1,73 +1,435 @@
 import multiprocessing as mp
+import os
+import time
+from functools import partial
 from pathlib import Path
-from typing import TYPE_CHECKING
+from queue import Empty
+from typing import TYPE_CHECKING, Optional, Union
 
 import click
 from loguru import logger
 from tqdm import tqdm
 
-from fish_audio_preprocess.utils.file import AUDIO_EXTENSIONS, list_files, make_dirs
+from fish_audio_preprocess.utils.file import (
+    AUDIO_EXTENSIONS,
+    list_files,
+    make_dirs,
+    probe_duration,
+)
+from fish_audio_preprocess.utils.writer import BackgroundWriter, prefetch
 
 if TYPE_CHECKING:
     import torch
 
 
+def plan_batches(
+    files: list[Path], batch_size: int = 1, batch_max_duration: float = 30.0
+) -> list[list[Path]]:
+    """Group the files separated together, longest batches first
+
+    Files up to batch_max_duration are sorted by duration, so the files of a
+    batch are padded as little as possible, longer ones are separated alone.
+    Batches are then ordered by their padded duration, from the header of each
+    file, so that the workers end with the shortest ones and finish together.
+
+    Args:
+        files: files to separate
+        batch_size: maximum number of files of a batch
+        batch_max_duration: maximum duration of a file to be batched
+
+    Returns:
+        the files of each batch
+    """
+
+    # Files of unknown duration go first, they can be arbitrarily long
+    durations = [
+        d if (d := probe_duration(file)) is not None else float("inf") for file in files
+    ]
+    short = sorted(
+        (duration, file)
+        for file, duration in zip(files, durations)
+        if duration <= batch_max_duration and batch_size > 1
+    )
+    batches = [short[i : i + batch_size] for i in range(0, len(short), batch_size)] + [
+        [(duration, file)]
+        for file, duration in zip(files, durations)
+        if duration > batch_max_duration or batch_size <= 1
+    ]
+    batches.sort(key=lambda batch: len(batch) * batch[-1][0], reverse=True)
+
+    return [[file for _, file in batch] for batch in batches]
+
+
+def parse_output_specs(
+    output_dir: Path, specs: list[str]
+) -> list[tuple[Path, list[str]]]:
+    """Parse NAME=STEM+STEM output specs
+
+    Args:
+        output_dir: root output directory
+        specs: the specs
+
+    Returns:
+        output directory and stems of each spec
+    """
+
+    outputs = {}
+
+    for spec in specs:
+        name, _, stems = spec.partition("=")
+        stems = [stem.strip() for stem in stems.split("+") if stem.strip()]
+
+        if not name or not stems:
+            raise ValueError(f"Invalid output {spec}, expected NAME=STEM+STEM")
+
+        if name in outputs:
+            raise ValueError(f"Output {name} is given twice")
+
+        outputs[name] = stems
+
+    return [(output_dir / name, stems) for name, stems in outputs.items()]
+
+
 def worker(
-    input_dir: str,
-    output_dir: str,
-    recursive: bool,
-    overwrite: bool,
-    track: list[str],
+    batches: Union[list[list[Path]], "mp.Queue"],
+    input_dir: Path,
+    outputs: list[tuple[Path, list[str]]],
     model: str,
     shifts: int,
     device: "torch.device",
-    shard_idx: int = -1,
-    total_shards: int = 1,
+    progress: Optional["mp.Queue"] = None,
+    name: str = "[Worker]",
+    shared_model: Optional["torch.nn.Module"] = None,
+    num_threads: Optional[int] = None,
+    prefetch_size: int = 2,
+    cache_dir: Optional[str] = None,
+    cache_size: float = 20.0,
+    precision: str = "fp32",
+    compile_model: bool = False,
+    skip_silence: bool = False,
+    silence_db: float = -60.0,
+    max_memory: Optional[float] = None,
+    noise_db: Optional[float] = None,
 ):
+    """Separate batches of files
+
+    Args:
+        batches: the batches, or a queue of batches ended by None, shared with the
+            other workers, so that a free worker takes the next batch
+        input_dir: input directory, the outputs keep the paths relative to it
+        outputs: output directory and stems of each merged track
+        model: name of the model
+        shifts: number of shifts
+        device: device of the model
+        progress: queue receiving the number of files done, shows a progress bar
+            of its own if None
+        name: name of the worker in the logs
+        shared_model: the model, loaded by the parent, instead of loading it here
+        num_threads: number of torch threads
+        prefetch_size: number of batches decoded ahead of the model
+        cache_dir: cache directory of the separated stems, no cache if None
+        cache_size: maximum size of the cache in GB
+        precision: precision of the model, see PRECISIONS
+        compile_model: compile the model with torch.compile
+        skip_silence: only separate the non-silent parts of each file
+        silence_db: rms in dBFS below which a part is silent, see active_regions
+        max_memory: memory budget of the separation in GB, see plan_memory
+        noise_db: rms in dBFS below which a noise-like part is silent too, off if
+            None, see active_regions
+    """
+
+    import torch
+
+    from fish_audio_preprocess.utils.cache import evict_lru
+    from fish_audio_preprocess.utils.energy import active_regions
     from fish_audio_preprocess.utils.separate_audio import (
         init_model,
+        load_cached_tracks,
         load_track,
         merge_tracks,
+        plan_memory,
         save_audio,
-        separate_audio,
+        save_cached_tracks,
+        separate_audio_batch,
+        separate_audio_streamed,
+        set_segment,
+        tracks_cache_file,
     )
 
-    files = list_files(input_dir, extensions=AUDIO_EXTENSIONS, recursive=recursive)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
 
-    if shard_idx >= 0:
-        files = [f for i, f in enumerate(files) if i % total_shards == shard_idx]
+    # The weights may be shared with the other workers, see separate
+    _model = (
+        shared_model
+        if shared_model is not None
+        else init_model(model, device, precision=precision, compile_model=compile_model)
+    )
 
-    shard_name = f"[Shard {shard_idx + 1}/{total_shards}]"
-    logger.info(f"{shard_name} Found {len(files)} files, separating audio")
+    for _, stems in outputs:
+        unknown = set(stems) - set(_model.sources)
 
-    _model = init_model(model, device)
+        if unknown:
+            raise ValueError(
+                f"Unknown stems {sorted(unknown)}, {model} has {_model.sources}"
+            )
 
-    skipped = 0
-    for file in tqdm(
-        files,
-        desc=f"{shard_name} Separating audio",
-        position=0 if shard_idx < 0 else shard_idx,
-        leave=False,
+    overlap, chunk = 0.25, None
+
+    if max_memory is not None:
+        segment, overlap, chunk = plan_memory(_model, max_memory * 2**30)
+        set_segment(_model, segment)
+        logger.info(
+            f"{name} Segment: {segment:.2f} s, overlap: {overlap:.2f}, "
+            f"files over {chunk / _model.samplerate:.0f} s are separated in chunks"
+        )
+
+        # The plan holds one decoded batch, batches decoded ahead would not fit
+        if prefetch_size > 0:
+            logger.info(f"{name} Prefetch is disabled by --max-memory")
+            prefetch_size = 0
+
+    pbar = None
+
+    if progress is None:
+        pbar = tqdm(total=sum(len(batch) for batch in batches), desc="Separating audio")
+
+    if not isinstance(batches, list):
+        batches = iter(batches.get, None)
+        # A batch held ahead can't be taken by an idle worker, e.g. one that
+        # started late, so it is only taken when the model is free, the other
+        # workers keep the CPU or GPU busy meanwhile
+        prefetch_size = 0
+
+    # Decoding of the next batches and writing of the previous ones run in
+    # background threads, while the model separates the current batch
+    writer = BackgroundWriter()
+    decode_time = separate_time = 0.0
+    done = cache_hits = evicted = total_samples = skipped_samples = 0
+    start = time.perf_counter()
+
+    if cache_dir is not None:
+        # The cache is trimmed to 90% of its size whenever the entries written
+        # since may have filled it, instead of being scanned for every entry
+        cache_low = int(0.9 * cache_size * 2**30)
+        evicted = evict_lru(cache_dir, cache_low)
+        cache_used = cache_low
+
+    def cache_tracks(path, tracks):
+        # Runs on the writer thread only
+        nonlocal cache_used, evicted
+
+        save_cached_tracks(path, tracks)
+        cache_used += path.stat().st_size
+
+        if cache_used > cache_size * 2**30:
+            evicted += evict_lru(cache_dir, cache_low)
+            cache_used = cache_low
+
+    def decode(batch):
+        sources = [load_track(_model, file) for file in batch]
+        regions = [None] * len(batch)
+
+        # The silence screen and the hashing run here too, off the model's thread
+        if skip_silence:
+            regions = [
+                active_regions(
+                    source.mean(0).numpy(),
+                    _model.samplerate,
+                    silence_db=silence_db,
+                    noise_db=noise_db,
+                )
+                for source in sources
+            ]
+
+        if cache_dir is None:
+            return sources, regions, [None] * len(batch), [None] * len(batch)
+
+        paths = [
+            tracks_cache_file(
+                cache_dir,
+                _model,
+                model,
+                source,
+                shifts,
+                precision,
+                silence_db if skip_silence else None,
+                overlap,
+                noise_db if skip_silence else None,
+            )
+            for source in sources
+        ]
+
+        return sources, regions, paths, [load_cached_tracks(path) for path in paths]
+
+    for batch, (sources, regions, paths, separated), elapsed in prefetch(
+        decode, batches, prefetch_size
     ):
-        # Get relative path to input_dir
-        relative_path = file.relative_to(input_dir)
-        new_file = output_dir / relative_path
+        decode_time += elapsed
+        misses = [idx for idx, tracks in enumerate(separated) if tracks is None]
+        cache_hits += len(batch) - len(misses)
+        groups = [misses]
 
-        if new_file.parent.exists() is False:
-            new_file.parent.mkdir(parents=True)
+        if chunk is not None:
+            # Files over the budget are written chunk by chunk, without the cache
+            streamed = [idx for idx in misses if sources[idx].shape[-1] > chunk]
+            misses = [idx for idx in misses if idx not in streamed]
 
-        if new_file.exists() and overwrite is False:
-            skipped += 1
-            continue
+            for idx in streamed:
+                # load_track decodes the whole file, only the tracks are chunked
+                decoded = sources[idx].numel() * sources[idx].element_size()
 
-        source = load_track(_model, file)
-        separated = separate_audio(_model, source, shifts=shifts, num_workers=0)
-        merged = merge_tracks(separated, track)
-        save_audio(_model, new_file, merged)
+                if decoded > max_memory * 2**30:
+                    logger.warning(
+                        f"{name} {batch[idx]} takes {decoded / 2**30:.2f} GB "
+                        f"decoded, over the memory budget on its own"
+                    )
 
-    logger.info(f"Done!")
-    logger.info(f"Total: {len(files)}, Skipped: {skipped}")
-    logger.info(f"Output directory: {output_dir}")
+                if skip_silence:
+                    logger.info(
+                        f"{name} {batch[idx]} is separated in chunks, "
+                        f"its silences are separated too"
+                    )
+
+                separate_start = time.perf_counter()
+                separate_audio_streamed(
+                    _model,
+                    sources[idx],
+                    [
+                        (root / batch[idx].relative_to(input_dir), stems)
+                        for root, stems in outputs
+                    ],
+                    chunk,
+                    shifts=shifts,
+                    overlap=overlap,
+                )
+                separate_time += time.perf_counter() - separate_start
+                total_samples += sources[idx].shape[-1]
+
+            # A batch over the budget is separated one file at a time
+            padded = len(misses) * max(
+                (sources[idx].shape[-1] for idx in misses), default=0
+            )
+            groups = [[idx] for idx in misses] if padded > chunk else [misses]
+
+        for group in groups:
+            if not group:
+                continue
+
+            separate_start = time.perf_counter()
+            results = separate_audio_batch(
+                _model,
+                [sources[idx] for idx in group],
+                shifts=shifts,
+                regions=[regions[idx] for idx in group] if skip_silence else None,
+                overlap=overlap,
+            )
+            separate_time += time.perf_counter() - separate_start
+
+            for idx, tracks in zip(group, results):
+                separated[idx] = tracks
+                total_samples += sources[idx].shape[-1]
+
+                if skip_silence:
+                    skipped_samples += sources[idx].shape[-1] - sum(
+                        end - start for start, end in regions[idx]
+                    )
+
+                if paths[idx] is not None:
+                    writer.submit(cache_tracks, paths[idx], tracks)
+
+        for file, tracks in zip(batch, separated):
+            # Already written by separate_audio_streamed
+            if tracks is None:
+                continue
+
+            for root, stems in outputs:
+                # The writer reports failures with the first argument, the path
+                writer.submit(
+                    partial(save_audio, _model),
+                    root / file.relative_to(input_dir),
+                    merge_tracks(tracks, stems),
+                )
+
+        done += len(batch)
+
+        if pbar is None:
+            progress.put(len(batch))
+        else:
+            pbar.update(len(batch))
+
+    writer.close()
+
+    if pbar is not None:
+        pbar.close()
+
+    logger.info(
+        f"{name} Separated {done} files, "
+        f"wall time: {time.perf_counter() - start:.1f} s, "
+        f"decode: {decode_time:.1f} s, separate: {separate_time:.1f} s, "
+        f"write: {writer.busy:.1f} s"
+    )
+
+    if skip_silence and total_samples > 0:
+        # The model time scales with the length of what it separates
+        separated_samples = total_samples - skipped_samples
+        avoided = separate_time * skipped_samples / max(separated_samples, 1)
+        logger.info(
+            f"{name} Silence skipped: {skipped_samples / _model.samplerate:.1f} s "
+            f"of {total_samples / _model.samplerate:.1f} s "
+            f"({skipped_samples / total_samples:.1%}), "
+            f"model time avoided: about {avoided:.1f} s"
+        )
+
+    if cache_dir is not None:
+        logger.info(f"{name} Cache hits: {cache_hits}/{done}, evicted: {evicted}")
+
+
+def run_workers(
+    context,
+    batches: list[list[Path]],
+    workers: list[tuple[tuple, dict]],
+):
+    """Run workers in processes, taking batches from a shared queue
+
+    Args:
+        context: multiprocessing context of the processes
+        batches: the batches, longest first
+        workers: positional arguments after batches and keyword arguments of
+            each worker
+    """
+
+    tasks, progress = context.Queue(), context.Queue()
+
+    for batch in batches:
+        tasks.put(batch)
+
+    # One end marker per worker
+    for _ in workers:
+        tasks.put(None)
+
+    processes = []
+
+    for args, kwargs in workers:
+        p = context.Process(
+            target=worker,
+            args=(tasks, *args),
+            kwargs=dict(**kwargs, progress=progress),
+        )
+        p.start()
+        processes.append(p)
+
+    with tqdm(
+        total=sum(len(batch) for batch in batches), desc="Separating audio"
+    ) as pbar:
+        while any(p.is_alive() for p in processes) or not progress.empty():
+            try:
+                pbar.update(progress.get(timeout=0.5))
+            except Empty:
+                pass
+
+    for p in processes:
+        p.join()
 
 
 @click.command()
@@ -83,11 +445,118 @@ def worker(
 @click.option(
     "--track", "-t", multiple=True, help="Name of track to keep", default=["vocals"]
 )
+@click.option(
+    "--output",
+    "-o",
+    "output_specs",
+    multiple=True,
+    help="Write the sum of some stems to output_dir/NAME, as NAME=STEM+STEM "
+    "(e.g. vocals=vocals, inst=drums+bass+other), repeat to write several "
+    "tracks from one separation, overrides --track",
+)
 @click.option("--model", help="Name of model to use", default="htdemucs")
 @click.option(
     "--shifts", help="Number of shifts, improves separation quality a bit", default=1
 )
 @click.option("--num_workers_per_gpu", help="Number of workers per GPU", default=2)
+@click.option(
+    "--batch-size",
+    help="Number of short files separated together in each model forward",
+    default=1,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--batch-max-duration",
+    help="Files longer than this many seconds are separated alone",
+    default=30.0,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--num-cpu-workers",
+    help="Number of processes separating on CPU when there is no GPU, "
+    "they share one copy of the model weights",
+    default=1,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--num-threads",
+    help="Total number of torch threads on CPU, split evenly between the CPU workers, "
+    "defaults to torch's choice for one worker and to the number of CPU cores otherwise",
+    default=None,
+    type=int,
+)
+@click.option(
+    "--prefetch",
+    "prefetch_size",
+    help="Number of batches decoded ahead of the model, 0 to decode inline, "
+    "only used by a single worker, several workers would hold batches others "
+    "could take, and disabled by --max-memory",
+    default=2,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--cache-dir",
+    help="Cache the separated stems of each audio in this directory, keyed by "
+    "the decoded audio, so renamed or moved copies are not separated again",
+    default=None,
+    type=click.Path(file_okay=False),
+)
+@click.option(
+    "--cache-size",
+    help="Maximum size of the cache in GB, least recently used entries are evicted "
+    "as it fills up",
+    default=20.0,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--precision",
+    help="Precision of the model, bf16 computes the convolution and linear layers "
+    "in bfloat16, int8 quantizes the linear and LSTM layers (CPU only)",
+    default="fp32",
+    show_default=True,
+    type=click.Choice(["fp32", "bf16", "int8"]),
+)
+@click.option(
+    "--compile/--no-compile",
+    "compile_model",
+    default=False,
+    help="Compile the model with torch.compile, the first batches are slower",
+)
+@click.option(
+    "--skip-silence/--no-skip-silence",
+    default=False,
+    help="Only feed the non-silent parts of each file to the model, "
+    "silences of 2 seconds or more are left silent",
+)
+@click.option(
+    "--silence-db",
+    help="Level in dBFS below which audio is silent, with --skip-silence",
+    default=-60.0,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--noise-db",
+    help="With --skip-silence, also leave silent the noise-like audio, with a flat "
+    "spectrum, below this level in dBFS, e.g. -45. Off by default, since "
+    "whispers, breaths and unvoiced speech are noise-like too",
+    default=None,
+    type=float,
+)
+@click.option(
+    "--max-memory",
+    help="Memory budget of each worker in GB, picks the segment and overlap of "
+    "the model, files too long for it are separated and written in chunks, "
+    "disables --prefetch. Each file is still decoded whole, on top of the budget "
+    "for files separated in chunks, and --skip-silence does not apply to them",
+    default=None,
+    type=float,
+)
 def separate(
     input_dir: str,
     output_dir: str,
@@ -95,9 +564,23 @@ def separate(
     overwrite: bool,
     clean: bool,
     track: list[str],
+    output_specs: list[str],
     model: str,
     shifts: int,
     num_workers_per_gpu: int,
+    batch_size: int,
+    batch_max_duration: float,
+    num_cpu_workers: int,
+    num_threads: Optional[int],
+    prefetch_size: int,
+    cache_dir: Optional[str],
+    cache_size: float,
+    precision: str,
+    compile_model: bool,
+    skip_silence: bool,
+    silence_db: float,
+    noise_db: Optional[float],
+    max_memory: Optional[float],
 ):
     """
     Separates audio in input_dir using model and saves to output_dir.
@@ -109,49 +592,127 @@ def separate(
         logger.error("You are trying to clean the input directory, aborting")
         return
 
+    # Output directory and stems of each merged track, all from one separation
+    outputs = [(output_dir, track)]
+
+    if output_specs:
+        try:
+            outputs = parse_output_specs(output_dir, output_specs)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--output")
+
     make_dirs(output_dir, clean)
 
-    base_args = (
-        input_dir,
-        output_dir,
-        recursive,
-        overwrite,
-        track,
-        model,
-        shifts,
+    # Files are listed once here and handed out to the workers
+    files = list_files(input_dir, extensions=AUDIO_EXTENSIONS, recursive=recursive)
+    logger.info(f"Found {len(files)} files, separating audio")
+
+    skipped = 0
+    pending = []
+
+    for file in files:
+        # Get relative path to input_dir
+        relative_path = file.relative_to(input_dir)
+        new_files = [root / relative_path for root, _ in outputs]
+
+        for new_file in new_files:
+            if new_file.parent.exists() is False:
+                new_file.parent.mkdir(parents=True, exist_ok=True)
+
+        if all(new_file.exists() for new_file in new_files) and overwrite is False:
+            skipped += 1
+            continue
+
+        pending.append(file)
+
+    batches = plan_batches(pending, batch_size, batch_max_duration)
+    base_args = (input_dir, outputs, model, shifts)
+    worker_kwargs = dict(
+        prefetch_size=prefetch_size,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        precision=precision,
+        compile_model=compile_model,
+        skip_silence=skip_silence,
+        silence_db=silence_db,
+        max_memory=max_memory,
+        noise_db=noise_db,
     )
 
     import torch
 
+    if precision == "int8" and torch.cuda.is_available():
+        raise click.BadParameter(
+            "int8 is only supported on CPU", param_hint="--precision"
+        )
+
     if torch.cuda.is_available() and torch.cuda.device_count() >= 1:
         logger.info(f"Device has {torch.cuda.device_count()} GPUs, let's use them!")
 
-        mp.set_start_method("spawn")
-
-        processes = []
-        shards = torch.cuda.device_count() * num_workers_per_gpu
-        for shard_idx in range(shards):
-            p = mp.Process(
-                target=worker,
-                args=(
-                    *base_args,
-                    torch.device(f"cuda:{shard_idx % torch.cuda.device_count()}"),
-                    shard_idx,
-                    shards,
-                ),
-            )
-            p.start()
-            processes.append(p)
+        gpus = torch.cuda.device_count()
+        workers = gpus * num_workers_per_gpu
+        run_workers(
+            mp.get_context("spawn"),
+            batches,
+            [
+                (
+                    (*base_args, torch.device(f"cuda:{idx % gpus}")),
+                    dict(**worker_kwargs, name=f"[Worker {idx + 1}/{workers}]"),
+                )
+                for idx in range(workers)
+            ],
+        )
+    elif num_cpu_workers > 1:
+        import torch.multiprocessing as tmp
 
-        for p in processes:
-            p.join()
+        from fish_audio_preprocess.utils.separate_audio import init_model
 
-        return
+        # Load the model once, its weights are moved to shared memory and every
+        # worker gets a handle to them instead of a copy
+        shared_model = init_model(
+            model,
+            torch.device("cpu"),
+            precision=precision,
+            compile_model=compile_model,
+        )
+        shared_model.share_memory()
 
-    worker(
-        *base_args,
-        torch.device("cuda" if torch.cuda.is_available() else "cpu"),
-    )
+        threads = max(1, (num_threads or os.cpu_count()) // num_cpu_workers)
+        logger.info(
+            f"Separating on CPU with {num_cpu_workers} workers "
+            f"of {threads} threads each"
+        )
+
+        run_workers(
+            tmp.get_context(
+                "fork" if "fork" in tmp.get_all_start_methods() else "spawn"
+            ),
+            batches,
+            [
+                (
+                    (*base_args, torch.device("cpu")),
+                    dict(
+                        **worker_kwargs,
+                        name=f"[Worker {idx + 1}/{num_cpu_workers}]",
+                        shared_model=shared_model,
+                        num_threads=threads,
+                    ),
+                )
+                for idx in range(num_cpu_workers)
+            ],
+        )
+    else:
+        worker(
+            batches,
+            *base_args,
+            torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+            num_threads=num_threads,
+            **worker_kwargs,
+        )
+
+    logger.info("Done!")
+    logger.info(f"Total: {len(files)}, Skipped: {skipped}")
+    logger.info(f"Output directory: {output_dir}")
 
 
 if __name__ == "__main__":
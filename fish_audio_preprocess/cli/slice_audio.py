@@ -1,12 +1,32 @@
+import itertools
+import json
 import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Optional
 
 import click
 from loguru import logger
 from tqdm import tqdm
 
-from fish_audio_preprocess.utils.file import AUDIO_EXTENSIONS, list_files, make_dirs
+from fish_audio_preprocess.utils.cache import DEFAULT_CACHE_DIR, evict_lru
+from fish_audio_preprocess.utils.file import (
+    AUDIO_EXTENSIONS,
+    list_files,
+    make_dirs,
+    probe_duration,
+)
+from fish_audio_preprocess.utils.manifest import MANIFEST_FORMATS, write_manifest
+
+
+def _is_long(file: Path, parallel_threshold: float) -> bool:
+    if parallel_threshold <= 0:
+        return False
+
+    duration = probe_duration(file)
+
+    # Files soundfile can't read are decoded whole by librosa, in a single worker
+    return duration is not None and duration > parallel_threshold
 
 
 @click.command()
@@ -68,6 +88,37 @@ from fish_audio_preprocess.utils.file import AUDIO_EXTENSIONS, list_files, make_
     show_default=True,
     type=int,
 )
+@click.option(
+    "--streaming/--no-streaming",
+    default=False,
+    help="Decode files block by block with constant memory instead of loading them whole",
+)
+@click.option(
+    "--index-only/--no-index-only",
+    default=False,
+    help="Write a manifest of slice timestamps instead of slice audio files, "
+    "covering every file, including those already sliced",
+)
+@click.option(
+    "--manifest-format",
+    help="Format of the manifest written by --index-only",
+    default="jsonl",
+    show_default=True,
+    type=click.Choice(MANIFEST_FORMATS),
+)
+@click.option(
+    "--async-write/--no-async-write",
+    default=True,
+    help="Write slices from a background thread of each worker",
+)
+@click.option(
+    "--parallel-threshold",
+    help="Files longer than this many seconds are sliced by all workers together, "
+    "0 to disable",
+    default=1800.0,
+    show_default=True,
+    type=float,
+)
 def slice_audio(
     input_dir: str,
     output_dir: str,
@@ -81,10 +132,18 @@ def slice_audio(
     top_db: int,
     frame_length: int,
     hop_length: int,
+    streaming: bool,
+    index_only: bool,
+    manifest_format: str,
+    async_write: bool,
+    parallel_threshold: float,
 ):
     """Slice audio files into smaller chunks by silence."""
 
-    from fish_audio_preprocess.utils.slice_audio import slice_audio_file
+    from fish_audio_preprocess.utils.slice_audio import (
+        slice_audio_file,
+        slice_audio_file_parallel,
+    )
 
     input_dir, output_dir = Path(input_dir), Path(output_dir)
 
@@ -98,39 +157,77 @@ def slice_audio(
     logger.info(f"Found {len(files)} files, processing...")
 
     skipped = 0
+    kwargs = dict(
+        min_duration=min_duration,
+        max_duration=max_duration,
+        pad_silence=pad_silence,
+        top_db=top_db,
+        frame_length=frame_length,
+        hop_length=hop_length,
+        index_only=index_only,
+    )
 
     with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        tasks = []
+        tasks, long_files = [], []
 
         for file in tqdm(files, desc="Preparing tasks"):
             # Get relative path to input_dir
             relative_path = file.relative_to(input_dir)
             save_path = output_dir / relative_path.parent / relative_path.stem
 
-            if save_path.exists() and not overwrite:
+            # Nothing is written in index-only mode, and the manifest must list
+            # every file, including those sliced by an earlier run
+            if save_path.exists() and not overwrite and not index_only:
                 skipped += 1
                 continue
 
-            if save_path.exists() is False:
+            if not index_only and save_path.exists() is False:
                 save_path.mkdir(parents=True)
 
+            if _is_long(file, parallel_threshold):
+                long_files.append((file, save_path))
+                continue
+
             tasks.append(
                 executor.submit(
                     slice_audio_file,
                     input_file=str(file),
                     output_dir=save_path,
-                    min_duration=min_duration,
-                    max_duration=max_duration,
-                    pad_silence=pad_silence,
-                    top_db=top_db,
-                    frame_length=frame_length,
-                    hop_length=hop_length,
+                    streaming=streaming,
+                    async_write=async_write,
+                    **kwargs,
                 )
             )
 
+        records = []
+
         for i in tqdm(as_completed(tasks), total=len(tasks), desc="Processing"):
             assert i.exception() is None, i.exception()
 
+            if index_only:
+                records.extend(i.result())
+
+        # Long files are split over the whole pool, one at a time
+        for file, save_path in tqdm(
+            long_files, desc="Processing long files", disable=len(long_files) == 0
+        ):
+            result = slice_audio_file_parallel(
+                executor,
+                input_file=str(file),
+                output_dir=save_path,
+                n_tasks=num_workers * 4,
+                **kwargs,
+            )
+
+            if index_only:
+                records.extend(result)
+
+    if index_only:
+        records.sort(key=lambda record: (record["source"], record["index"]))
+        manifest = output_dir / f"manifest.{manifest_format}"
+        write_manifest(manifest, records)
+        logger.info(f"Wrote {len(records)} slices to {manifest}")
+
     logger.info("Done!")
     logger.info(f"Total: {len(files)}, Skipped: {skipped}")
     logger.info(f"Output directory: {output_dir}")
@@ -203,6 +300,32 @@ def slice_audio(
     default=False,
     help="Merge short slices automatically",
 )
+@click.option(
+    "--index-only/--no-index-only",
+    default=False,
+    help="Write a manifest of slice timestamps instead of slice audio files, "
+    "covering every file, including those already sliced",
+)
+@click.option(
+    "--manifest-format",
+    help="Format of the manifest written by --index-only",
+    default="jsonl",
+    show_default=True,
+    type=click.Choice(MANIFEST_FORMATS),
+)
+@click.option(
+    "--async-write/--no-async-write",
+    default=True,
+    help="Write slices from a background thread of each worker",
+)
+@click.option(
+    "--parallel-threshold",
+    help="Files longer than this many seconds are sliced by all workers together, "
+    "0 to disable",
+    default=1800.0,
+    show_default=True,
+    type=float,
+)
 def slice_audio_v2(
     input_dir: str,
     output_dir: str,
@@ -218,10 +341,17 @@ def slice_audio_v2(
     max_silence_kept: float,
     flat_layout: bool,
     merge_short: bool,
+    index_only: bool,
+    manifest_format: str,
+    async_write: bool,
+    parallel_threshold: float,
 ):
     """(OpenVPI version) Slice audio files into smaller chunks by silence."""
 
-    from fish_audio_preprocess.utils.slice_audio_v2 import slice_audio_file_v2
+    from fish_audio_preprocess.utils.slice_audio_v2 import (
+        slice_audio_file_v2,
+        slice_audio_file_v2_parallel,
+    )
 
     input_dir, output_dir = Path(input_dir), Path(output_dir)
 
@@ -241,53 +371,303 @@ def slice_audio_v2(
     logger.info(f"Found {len(files)} files, processing...")
 
     skipped = 0
+    kwargs = dict(
+        min_duration=min_duration,
+        max_duration=max_duration,
+        min_silence_duration=min_silence_duration,
+        top_db=top_db,
+        hop_length=hop_length,
+        max_silence_kept=max_silence_kept,
+        flat_layout=flat_layout,
+        merge_short=merge_short,
+        index_only=index_only,
+    )
 
     with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        tasks = []
+        tasks, long_files = [], []
 
         for file in tqdm(files, desc="Preparing tasks"):
             # Get relative path to input_dir
             relative_path = file.relative_to(input_dir)
             save_path = output_dir / relative_path.parent / relative_path.stem
 
-            if save_path.exists() and not overwrite:
+            # Nothing is written in index-only mode, and the manifest must list
+            # every file, including those sliced by an earlier run
+            if save_path.exists() and not overwrite and not index_only:
                 skipped += 1
                 continue
 
             if (
-                output_dir / relative_path.parent / relative_path.stem
-                if not flat_layout
-                else output_dir / relative_path.parent
-            ).exists() is False:
+                not index_only
+                and (
+                    output_dir / relative_path.parent / relative_path.stem
+                    if not flat_layout
+                    else output_dir / relative_path.parent
+                ).exists()
+                is False
+            ):
                 (
                     output_dir / relative_path.parent / relative_path.stem
                     if not flat_layout
                     else output_dir / relative_path.parent
                 ).mkdir(parents=True)
 
+            if _is_long(file, parallel_threshold):
+                long_files.append((file, save_path))
+                continue
+
             tasks.append(
                 executor.submit(
                     slice_audio_file_v2,
                     input_file=str(file),
                     output_dir=save_path,
-                    min_duration=min_duration,
-                    max_duration=max_duration,
-                    min_silence_duration=min_silence_duration,
-                    top_db=top_db,
-                    hop_length=hop_length,
-                    max_silence_kept=max_silence_kept,
-                    flat_layout=flat_layout,
-                    merge_short=merge_short,
+                    async_write=async_write,
+                    **kwargs,
                 )
             )
 
+        records = []
+
         for i in tqdm(as_completed(tasks), total=len(tasks), desc="Processing"):
             assert i.exception() is None, i.exception()
 
+            if index_only:
+                records.extend(i.result())
+
+        # Long files are split over the whole pool, one at a time
+        for file, save_path in tqdm(
+            long_files, desc="Processing long files", disable=len(long_files) == 0
+        ):
+            result = slice_audio_file_v2_parallel(
+                executor,
+                input_file=str(file),
+                output_dir=save_path,
+                n_tasks=num_workers * 4,
+                **kwargs,
+            )
+
+            if index_only:
+                records.extend(result)
+
+    if index_only:
+        records.sort(key=lambda record: (record["source"], record["index"]))
+        manifest = output_dir / f"manifest.{manifest_format}"
+        write_manifest(manifest, records)
+        logger.info(f"Wrote {len(records)} slices to {manifest}")
+
     logger.info("Done!")
     logger.info(f"Total: {len(files)}, Skipped: {skipped}")
     logger.info(f"Output directory: {output_dir}")
 
 
+@click.command()
+@click.argument("input_dir", type=click.Path(exists=True, file_okay=False))
+@click.option("--recursive/--no-recursive", default=True, help="Search recursively")
+@click.option(
+    "--num-workers",
+    help="Number of workers to use for processing, defaults to number of CPU cores",
+    default=os.cpu_count(),
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--min-duration",
+    help="Minimum duration of each slice, repeat to sweep",
+    default=[5.0],
+    show_default=True,
+    multiple=True,
+    type=float,
+)
+@click.option(
+    "--max-duration",
+    help="Maximum duration of each slice",
+    default=30.0,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--min-silence-duration",
+    help="Minimum duration of silence, repeat to sweep",
+    default=[0.3],
+    show_default=True,
+    multiple=True,
+    type=float,
+)
+@click.option(
+    "--top-db",
+    help="Threshold to detect silence, repeat to sweep",
+    default=[-40],
+    show_default=True,
+    multiple=True,
+    type=int,
+)
+@click.option(
+    "--hop-length",
+    help="Hop length to detect silence",
+    default=10,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--max-silence-kept",
+    help="Maximum duration of silence to be kept, repeat to sweep",
+    default=[0.5],
+    show_default=True,
+    multiple=True,
+    type=float,
+)
+@click.option(
+    "--merge-short/--no-merge-short",
+    default=False,
+    help="Merge short slices automatically",
+)
+@click.option(
+    "--cache-dir",
+    help="Directory to cache the rms of each file",
+    default=DEFAULT_CACHE_DIR / "rms",
+    show_default=True,
+    type=click.Path(file_okay=False),
+)
+@click.option(
+    "--cache-size",
+    help="Maximum size of the rms cache in GB, least recently used entries are evicted",
+    default=5.0,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--report",
+    help="Write the statistics of every setting to this JSON file",
+    default=None,
+    type=click.Path(dir_okay=False),
+)
+def slice_sweep(
+    input_dir: str,
+    recursive: bool,
+    num_workers: int,
+    min_duration: list[float],
+    max_duration: float,
+    min_silence_duration: list[float],
+    top_db: list[int],
+    hop_length: int,
+    max_silence_kept: list[float],
+    merge_short: bool,
+    cache_dir: str,
+    cache_size: float,
+    report: Optional[str],
+):
+    """Evaluate a grid of slice-audio-v2 settings without writing any audio."""
+
+    import numpy as np
+
+    from fish_audio_preprocess.utils.slice_audio_v2 import sweep_file_v2
+
+    param_sets = []
+    for values in itertools.product(
+        min_duration, min_silence_duration, top_db, max_silence_kept
+    ):
+        params = dict(
+            zip(
+                ["min_duration", "min_silence_duration", "top_db", "max_silence_kept"],
+                values,
+            )
+        )
+
+        # Same constraints as the Slicer
+        if not (
+            params["min_duration"]
+            >= params["min_silence_duration"]
+            >= hop_length / 1000
+            and params["max_silence_kept"] >= hop_length / 1000
+        ):
+            logger.warning(f"Skipping invalid setting {params}")
+            continue
+
+        param_sets.append(params)
+
+    files = list_files(input_dir, extensions=AUDIO_EXTENSIONS, recursive=recursive)
+    logger.info(f"Found {len(files)} files, evaluating {len(param_sets)} settings")
+
+    # Durations of the slices of each file, for each setting
+    durations = [[] for _ in param_sets]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        tasks = [
+            executor.submit(
+                sweep_file_v2,
+                input_file=file,
+                param_sets=param_sets,
+                max_duration=max_duration,
+                hop_length=hop_length,
+                merge_short=merge_short,
+                cache_dir=cache_dir,
+            )
+            for file in tqdm(files, desc="Preparing tasks")
+        ]
+
+        for i in tqdm(as_completed(tasks), total=len(tasks), desc="Processing"):
+            assert i.exception() is None, i.exception()
+
+            for idx, result in enumerate(i.result()):
+                durations[idx].append(result)
+
+    if cache_dir is not None:
+        evicted = evict_lru(cache_dir, int(cache_size * 2**30))
+
+        if evicted > 0:
+            logger.info(f"Evicted {evicted} cache entries")
+
+    stats = []
+    for params, result in zip(param_sets, durations):
+        counts = [len(file_result) for file_result in result]
+        count_percentiles = (
+            np.percentile(counts, [0, 50, 90, 100]) if len(counts) > 0 else [0.0] * 4
+        )
+        result = np.concatenate(result) if len(result) > 0 else np.zeros(0)
+        percentiles = (
+            np.percentile(result, [0, 5, 25, 50, 75, 95, 100])
+            if len(result) > 0
+            else [0.0] * 7
+        )
+        stats.append(
+            {
+                **params,
+                "slices": len(result),
+                "slices_per_file": dict(
+                    zip(["min", "p50", "p90", "max"], map(float, count_percentiles))
+                ),
+                "total_hours": float(result.sum() / 3600),
+                "mean": float(result.mean()) if len(result) > 0 else 0.0,
+                "percentiles": dict(
+                    zip(
+                        ["min", "p5", "p25", "p50", "p75", "p95", "max"],
+                        map(float, percentiles),
+                    )
+                ),
+                "shorter_than_min_duration": int(
+                    (result < params["min_duration"]).sum()
+                ),
+            }
+        )
+
+        logger.info(
+            ", ".join(f"{k}={v}" for k, v in params.items())
+            + f": {stats[-1]['slices']} slices, "
+            + "per file min/p50/p90/max "
+            + "/".join(f"{p:g}" for p in count_percentiles)
+            + f", {stats[-1]['total_hours']:.2f} hours, "
+            + f"mean {stats[-1]['mean']:.2f}s, "
+            + "min/p5/p25/p50/p75/p95/max "
+            + "/".join(f"{p:.1f}" for p in percentiles)
+            + f"s, {stats[-1]['shorter_than_min_duration']} shorter than min duration"
+        )
+
+    if report is not None:
+        with open(report, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+        logger.info(f"Report saved to {report}")
+
+
 if __name__ == "__main__":
     slice_audio()
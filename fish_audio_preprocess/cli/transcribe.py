@@ -1,17 +1,23 @@
 import multiprocessing as mp
-from concurrent.futures import ProcessPoolExecutor
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import click
 import torch
 from loguru import logger
 from tqdm import tqdm
 
-from fish_audio_preprocess.utils.file import AUDIO_EXTENSIONS, list_files, split_list
-from fish_audio_preprocess.utils.transcribe import ASRModelType, batch_transcribe
-
-
-def replace_lastest(string, old, new):
-    return string[::-1].replace(old[::-1], new[::-1], 1)[::-1]
+from fish_audio_preprocess.utils.file import (
+    AUDIO_EXTENSIONS,
+    list_files,
+    probe_duration,
+)
+from fish_audio_preprocess.utils.transcribe import (
+    ASRModelType,
+    init_worker,
+    lab_path,
+    transcribe_file,
+)
 
 
 @click.command()
@@ -49,6 +55,11 @@ def replace_lastest(string, old, new):
     default="whisper",
     show_default=True,
 )
+@click.option(
+    "--overwrite/--no-overwrite",
+    default=False,
+    help="Transcribe again files that already have a .lab file",
+)
 def transcribe(
     input_dir: str,
     num_workers: int,
@@ -56,6 +67,7 @@ def transcribe(
     model_size: str,
     recursive: bool,
     model_type: ASRModelType,
+    overwrite: bool,
 ):
     """
     Transcribe audio files in a directory.
@@ -87,31 +99,54 @@ def transcribe(
         logger.error(f"No audio files found in {input_dir}.")
         return
 
-    # 按照 num workers 切块
-    chunks = split_list(audio_files, num_workers)
+    # Transcripts are written as soon as each file is done, so an interrupted
+    # run resumes where it stopped
+    if not overwrite:
+        total = len(audio_files)
+        audio_files = [file for file in audio_files if not lab_path(file).exists()]
+        logger.info(f"Skipped {total - len(audio_files)} already transcribed files")
+
+        if len(audio_files) == 0:
+            return
+
+    # Longest files first, so that the workers end with the short ones and
+    # finish together, unknown durations count as the longest
+    durations = {file: probe_duration(file) for file in audio_files}
+    audio_files.sort(
+        key=lambda file: (
+            durations[file] if durations[file] is not None else float("inf")
+        ),
+        reverse=True,
+    )
+
+    # Every worker loads its model once, then takes the next file as soon as
+    # it is free
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(model_size, model_type, lang),
+    ) as executor:
+        tasks = {executor.submit(transcribe_file, file): file for file in audio_files}
+        start = time.perf_counter()
+        audio_time = 0.0
+
+        with tqdm(total=len(tasks), desc="Transcribing") as pbar:
+            for task in as_completed(tasks):
+                task.result()
+                audio_time += durations[tasks[task]] or 0.0
+
+                # Empty or unreadable files have no duration to compare with
+                if audio_time > 0:
+                    pbar.set_postfix(
+                        rtf=f"{(time.perf_counter() - start) / audio_time:.3f}"
+                    )
 
-    with ProcessPoolExecutor(mp_context=mp.get_context("spawn")) as executor:
-        tasks = []
-        for chunk in chunks:
-            tasks.append(
-                executor.submit(
-                    batch_transcribe,
-                    files=chunk,
-                    model_size=model_size,
-                    model_type=model_type,
-                    lang=lang,
-                    pos=len(tasks),
-                )
-            )
-        results = {}
-        for task in tasks:
-            ret = task.result()
-            for res in ret.keys():
-                results[res] = ret[res]
+                pbar.update()
 
-        logger.info("Output to .lab file")
-        for file in tqdm(results.keys()):
-            path = replace_lastest(file, ".wav", ".lab")
-            # logger.info(path)
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(results[file])
+    elapsed = time.perf_counter() - start
+    rtf = f", real-time factor {elapsed / audio_time:.3f}" if audio_time > 0 else ""
+    logger.info(
+        f"Transcribed {len(audio_files)} files, {audio_time:.1f} s of audio "
+        f"in {elapsed:.1f} s{rtf}"
+    )
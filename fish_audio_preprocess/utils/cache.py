@@ -0,0 +1,153 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Union
+from zipfile import BadZipFile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "fish-audio-preprocess"
+
+
+def file_fingerprint(path: Union[Path, str]) -> str:
+    """Identify a file by its path, size and modification time.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        str: The fingerprint.
+    """
+
+    path = Path(path).resolve()
+    stat = path.stat()
+
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def cache_file(cache_dir: Union[Path, str], *key, suffix: str = ".npz") -> Path:
+    """Path of the cache entry of a key.
+
+    Args:
+        cache_dir (Union[Path, str]): Path to the cache directory.
+        *key: Anything with a stable repr, identifying the entry.
+        suffix (str, optional): Suffix of the entry. Defaults to ".npz".
+
+    Returns:
+        Path: Path to the entry, which may not exist yet.
+    """
+
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+
+    return Path(cache_dir) / digest[:2] / f"{digest}{suffix}"
+
+
+def array_digest(array: np.ndarray) -> str:
+    """Identify an array by its content.
+
+    Args:
+        array (np.ndarray): The array.
+
+    Returns:
+        str: The digest of its dtype, shape and data.
+    """
+
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(f"{array.dtype}:{array.shape}".encode())
+    digest.update(memoryview(array).cast("B"))
+
+    return digest.hexdigest()
+
+
+def load_npz(path: Union[Path, str]) -> Optional[dict[str, np.ndarray]]:
+    """Load a cache entry.
+
+    Args:
+        path (Union[Path, str]): Path to the entry.
+
+    Returns:
+        Optional[dict[str, np.ndarray]]: The arrays, or None if the entry is missing
+            or unreadable, unreadable entries are deleted.
+    """
+
+    try:
+        with np.load(path) as data:
+            arrays = dict(data)
+    except FileNotFoundError:
+        return None
+    except (BadZipFile, ValueError, OSError, KeyError, EOFError):
+        # Truncated or corrupt, e.g. written by a killed process, it is a miss
+        Path(path).unlink(missing_ok=True)
+        return None
+
+    # Mark the entry as recently used, see evict_lru
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return arrays
+
+
+def save_npz(path: Union[Path, str], compress: bool = False, **arrays: np.ndarray):
+    """Atomically save a cache entry, so that concurrent workers never read a partial file.
+
+    Args:
+        path (Union[Path, str]): Path to the entry.
+        compress (bool, optional): Deflate the arrays. Defaults to False.
+        **arrays (np.ndarray): The arrays to save.
+    """
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    with open(tmp, "wb") as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+
+    os.replace(tmp, path)
+
+
+def evict_lru(cache_dir: Union[Path, str], max_bytes: int) -> int:
+    """Delete the least recently used entries until the cache fits in max_bytes.
+
+    Entries are ordered by modification time, which load_npz updates on every hit.
+
+    Args:
+        cache_dir (Union[Path, str]): Path to the cache directory.
+        max_bytes (int): Maximum total size of the entries.
+
+    Returns:
+        int: The number of deleted entries.
+    """
+
+    entries = []
+
+    for path in Path(cache_dir).glob("*/*"):
+        # Entries being written by another worker are not counted
+        if path.suffix == ".tmp":
+            continue
+
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    deleted = 0
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+
+        try:
+            path.unlink()
+            deleted += 1
+        except FileNotFoundError:
+            pass
+
+        total -= size
+
+    return deleted
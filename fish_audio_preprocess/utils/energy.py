@@ -0,0 +1,164 @@
+from typing import Optional
+
+import numpy as np
+
+# Frames computed per cumulative sum, bounds both the temporary memory and the
+# float64 rounding error of long sums
+BLOCK_FRAMES = 4096
+
+
+def frame_power(
+    y: np.ndarray,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+    center: bool = True,
+) -> np.ndarray:
+    """Mean power of each frame, from a running sum of squared samples
+
+    Equivalent to librosa.feature.rms(y=y, ...) ** 2 with zero padding, but costs
+    O(n) for any frame_length and never builds a framed view of the signal.
+
+    Args:
+        y: audio data, in shape (samples,)
+        frame_length: frame length
+        hop_length: hop length
+        center: pad frame_length // 2 zeros on both sides, like librosa
+
+    Returns:
+        power of each frame, in float64
+    """
+
+    pad = frame_length // 2 if center else 0
+    n_frames = max(0, 1 + (len(y) + 2 * pad - frame_length) // hop_length)
+    power = np.empty(n_frames, dtype=np.float64)
+    squared = np.zeros(
+        min(len(y), hop_length * (BLOCK_FRAMES - 1) + frame_length) + 1,
+        dtype=np.float64,
+    )
+
+    for first in range(0, n_frames, BLOCK_FRAMES):
+        last = min(first + BLOCK_FRAMES, n_frames)
+        frame_starts = np.arange(first, last) * hop_length - pad
+
+        # Samples covered by this block of frames, the padding contributes zeros
+        begin = max(frame_starts[0], 0)
+        end = min(frame_starts[-1] + frame_length, len(y))
+        cumsum = squared[: end - begin + 1]
+        np.square(y[begin:end], out=cumsum[1:])
+        np.cumsum(cumsum, out=cumsum)
+
+        lo = np.clip(frame_starts - begin, 0, end - begin)
+        hi = np.clip(frame_starts + frame_length - begin, 0, end - begin)
+        power[first:last] = (cumsum[hi] - cumsum[lo]) / frame_length
+
+    return power
+
+
+def frame_rms(
+    y: np.ndarray,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+    center: bool = True,
+) -> np.ndarray:
+    """Root mean square of each frame, see frame_power
+
+    Args:
+        y: audio data, in shape (samples,)
+        frame_length: frame length
+        hop_length: hop length
+        center: pad frame_length // 2 zeros on both sides, like librosa
+
+    Returns:
+        rms of each frame, in float64
+    """
+
+    return np.sqrt(frame_power(y, frame_length, hop_length, center))
+
+
+def spectral_flatness(y: np.ndarray) -> float:
+    """Spectral flatness of a frame, about 0.56 for white noise and close to 0 for tones
+
+    Args:
+        y: audio data of the frame, in shape (samples,)
+
+    Returns:
+        geometric mean over arithmetic mean of the power spectrum
+    """
+
+    spectrum = np.abs(np.fft.rfft(y * np.hanning(len(y)))) ** 2 + 1e-20
+
+    return float(np.exp(np.mean(np.log(spectrum))) / np.mean(spectrum))
+
+
+def active_regions(
+    y: np.ndarray,
+    rate: int,
+    silence_db: float = -60.0,
+    noise_db: Optional[float] = None,
+    noise_flatness: float = 0.3,
+    min_silence: float = 2.0,
+    margin: float = 0.5,
+    frame_duration: float = 0.1,
+) -> list[tuple[int, int]]:
+    """Find the parts of an audio that are not silent
+
+    A frame is silent when its rms is below silence_db. With noise_db, a frame
+    below noise_db with a spectral flatness above noise_flatness, i.e. a quiet
+    noise floor without any tone, is silent too, which also catches whispers,
+    breaths and unvoiced speech. Runs of silent frames of at least min_silence
+    are dropped, the rest is kept with margin of context on both sides.
+
+    Args:
+        y: audio data, in shape (samples,)
+        rate: sample rate
+        silence_db: rms in dBFS below which a frame is silent
+        noise_db: rms in dBFS below which a noise-like frame is silent, None to
+            only use silence_db
+        noise_flatness: spectral flatness above which a frame is noise-like
+        min_silence: minimum duration of a dropped silence, in seconds
+        margin: duration kept around the non-silent parts, in seconds
+        frame_duration: duration of each frame, in seconds
+
+    Returns:
+        (start, end) samples of the non-silent parts, in order
+    """
+
+    frame = max(1, int(frame_duration * rate))
+    # The last partial frame, if any, is never silent
+    db = 10 * np.log10(frame_power(y, frame, frame, center=False) + 1e-20)
+    silent = db < silence_db
+
+    # Flatness is only needed for the quiet frames
+    if noise_db is not None:
+        for idx in np.flatnonzero(~silent & (db < noise_db)):
+            flatness = spectral_flatness(y[idx * frame : (idx + 1) * frame])
+            silent[idx] = flatness > noise_flatness
+
+    # Boundaries of the runs of silent frames
+    edges = np.diff(np.concatenate([[0], silent.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    keep = (ends - starts) * frame >= min_silence * rate
+    margin = int(margin * rate)
+
+    regions = []
+    position = 0
+
+    for start, end in zip(starts[keep] * frame, ends[keep] * frame):
+        if start > position:
+            regions.append((max(position - margin, 0), start + margin))
+
+        position = end
+
+    if position < len(y):
+        regions.append((max(position - margin, 0), len(y)))
+
+    # Parts closer than two margins are merged
+    merged = []
+
+    for start, end in regions:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return [(int(start), min(int(end), len(y))) for start, end in merged]
@@ -1,7 +1,7 @@
 import os
 import shutil
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from loguru import logger
 
@@ -98,3 +98,78 @@ def make_dirs(path: Union[Path, str], clean: bool = False):
             logger.info(f"Output directory already exists: {path}")
 
     path.mkdir(parents=True, exist_ok=True)
+
+
+def probe_duration(path: Union[Path, str]) -> Optional[float]:
+    """Read the duration of an audio file from its header, without decoding it.
+
+    Args:
+        path (Union[Path, str]): Path to the audio file.
+
+    Returns:
+        Optional[float]: Duration in seconds, or None if soundfile can't read the file.
+    """
+
+    import soundfile as sf
+
+    try:
+        return sf.info(str(path)).duration
+    except RuntimeError:
+        return None
+
+
+LINK_MODES = ("reflink", "hardlink", "copy")
+
+# ioctl request to clone a file on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path):
+    import fcntl
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_or_copy(
+    src: Union[Path, str], dst: Union[Path, str], mode: str = "reflink"
+) -> str:
+    """Link or copy a file, falling back to a plain copy when linking is not possible.
+
+    Args:
+        src (Union[Path, str]): Path to the source file.
+        dst (Union[Path, str]): Path to the destination file, replaced if it exists.
+        mode (str, optional): One of LINK_MODES. Defaults to "reflink".
+
+    Returns:
+        str: The method actually used, one of LINK_MODES, or "skipped" when
+            dst already is src, the same path or a hardlink to it.
+    """
+
+    if mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode {mode}, expected one of {LINK_MODES}")
+
+    src, dst = Path(src), Path(dst)
+
+    if dst.exists():
+        # Unlinking dst would delete src
+        if os.path.samefile(src, dst):
+            return "skipped"
+
+        dst.unlink()
+
+    try:
+        if mode == "hardlink":
+            os.link(src, dst)
+            return mode
+
+        if mode == "reflink":
+            _reflink(src, dst)
+            return mode
+    except (ImportError, OSError):
+        # Cross-device links, filesystems without reflink support, non-Linux...
+        pass
+
+    shutil.copyfile(src, dst)
+
+    return "copy"
@@ -0,0 +1,350 @@
+"""Compiled kernels of the slicing hot loops
+
+Every kernel is plain Python written for numba. When numba is installed, the
+kernels are compiled on first use and the slicers select them automatically,
+otherwise the slicers keep their numpy implementations. Both backends produce
+identical slice boundaries.
+
+Slices are passed to the kernels flattened: the pieces of all slices in two
+arrays, starts (-1 for padded silence) and ends (the length for padded silence),
+and the offsets of the first piece of each slice.
+"""
+
+import importlib.util
+from functools import wraps
+from typing import Optional
+
+import numpy as np
+
+KERNEL_BACKENDS = ("numpy", "numba")
+
+_backend = None
+
+
+def get_backend() -> str:
+    """Backend used by the slicers, numba if it is installed unless set otherwise
+
+    Returns:
+        one of KERNEL_BACKENDS
+    """
+
+    global _backend
+
+    if _backend is None:
+        _backend = "numba" if importlib.util.find_spec("numba") else "numpy"
+
+    return _backend
+
+
+def set_backend(backend: Optional[str] = None) -> None:
+    """Force the backend used by the slicers
+
+    Args:
+        backend: one of KERNEL_BACKENDS, or None to select it automatically
+    """
+
+    global _backend
+
+    if backend is not None and backend not in KERNEL_BACKENDS:
+        raise ValueError(
+            f"Unknown kernel backend {backend}, expected one of {KERNEL_BACKENDS}"
+        )
+
+    if backend == "numba" and importlib.util.find_spec("numba") is None:
+        raise ImportError("The numba kernel backend requires numba")
+
+    _backend = backend
+
+
+def jit(fn):
+    """Compile fn with numba on its first call, numba is only imported then"""
+
+    compiled = None
+
+    @wraps(fn)
+    def wrapper(*args):
+        nonlocal compiled
+
+        if compiled is None:
+            import numba
+
+            compiled = numba.njit(cache=True)(fn)
+
+        return compiled(*args)
+
+    wrapper.py_func = fn
+
+    return wrapper
+
+
+def flatten_slices(
+    slices: list[list[tuple[Optional[int], int]]],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten slices described by their pieces for the kernels
+
+    Args:
+        slices: pieces of each slice, (start, end) ranges of source samples or
+            (None, length) of silence
+
+    Returns:
+        starts, ends and offsets
+    """
+
+    offsets = np.zeros(len(slices) + 1, dtype=np.int64)
+    np.cumsum([len(pieces) for pieces in slices], out=offsets[1:])
+    pieces = [piece for pieces in slices for piece in pieces]
+
+    starts = np.array(
+        [-1 if start is None else start for start, _ in pieces], dtype=np.int64
+    )
+    ends = np.array([end for _, end in pieces], dtype=np.int64)
+
+    return starts, ends, offsets
+
+
+def unflatten_slices(
+    starts: np.ndarray, ends: np.ndarray, offsets: np.ndarray
+) -> list[list[tuple[Optional[int], int]]]:
+    """Inverse of flatten_slices
+
+    Args:
+        starts: start of each piece, -1 for padded silence
+        ends: end of each piece, or its length for padded silence
+        offsets: offset of the first piece of each slice, and the number of pieces
+
+    Returns:
+        pieces of each slice
+    """
+
+    pieces = [
+        (None if start < 0 else start, end)
+        for start, end in zip(starts.tolist(), ends.tolist())
+    ]
+    offsets = offsets.tolist()
+
+    return [pieces[begin:end] for begin, end in zip(offsets[:-1], offsets[1:])]
+
+
+@jit
+def sil_tags_kernel(rms_list, threshold, min_interval, min_length, max_sil_kept):
+    """The frame by frame loop of the original Slicer.slice
+
+    Args:
+        rms_list: rms of each frame
+        threshold: rms below which a frame is silent, in the dtype of rms_list
+        min_interval: minimum number of silent frames to cut
+        min_length: minimum number of frames of a clip
+        max_sil_kept: maximum number of silent frames kept around a cut
+
+    Returns:
+        (begin, end) frames to be removed, in shape (tags, 2)
+    """
+
+    total_frames = rms_list.shape[0]
+    # Silent runs are disjoint, every tag but the leading one is min_interval long
+    sil_tags = np.empty((total_frames // max(min_interval, 1) + 2, 2), np.int64)
+    n_tags = 0
+    silence_start = -1
+    clip_start = 0
+
+    for i in range(total_frames):
+        if rms_list[i] < threshold:
+            if silence_start < 0:
+                silence_start = i
+            continue
+
+        if silence_start < 0:
+            continue
+
+        is_leading_silence = silence_start == 0 and i > max_sil_kept
+        need_slice_middle = (
+            i - silence_start >= min_interval and i - clip_start >= min_length
+        )
+
+        if not is_leading_silence and not need_slice_middle:
+            silence_start = -1
+            continue
+
+        if i - silence_start <= max_sil_kept:
+            pos = rms_list[silence_start : i + 1].argmin() + silence_start
+            sil_tags[n_tags, 0] = 0 if silence_start == 0 else pos
+            sil_tags[n_tags, 1] = pos
+            clip_start = pos
+        else:
+            pos_l = (
+                rms_list[silence_start : silence_start + max_sil_kept + 1].argmin()
+                + silence_start
+            )
+            pos_r = rms_list[i - max_sil_kept : i + 1].argmin() + i - max_sil_kept
+            begin, end = pos_l, pos_r
+
+            if i - silence_start <= max_sil_kept * 2:
+                pos = (
+                    rms_list[
+                        i - max_sil_kept : silence_start + max_sil_kept + 1
+                    ].argmin()
+                    + i
+                    - max_sil_kept
+                )
+                begin, end = min(pos_l, pos), max(pos_r, pos)
+
+            if silence_start == 0:
+                begin, end = 0, pos_r
+
+            sil_tags[n_tags, 0] = begin
+            sil_tags[n_tags, 1] = end
+            clip_start = end
+
+        n_tags += 1
+        silence_start = -1
+
+    # Deal with trailing silence.
+    if silence_start >= 0 and total_frames - silence_start >= min_interval:
+        silence_end = min(total_frames, silence_start + max_sil_kept)
+        pos = rms_list[silence_start : silence_end + 1].argmin() + silence_start
+        sil_tags[n_tags, 0] = pos
+        sil_tags[n_tags, 1] = total_frames + 1
+        n_tags += 1
+
+    return sil_tags[:n_tags]
+
+
+@jit
+def group_intervals_kernel(starts, ends, rate, min_duration, pad, final):
+    """Group non-silent intervals into slices of at least min_duration
+
+    The loop of plan_slices, the intervals of a slice are separated by pad
+    samples of silence. Intervals can be fed block by block: unless final, the
+    last slice is left out if shorter than min_duration, and its intervals are
+    to be passed again at the start of the next block.
+
+    Args:
+        starts: start of each interval
+        ends: end of each interval
+        rate: sample rate
+        min_duration: minimum duration of each slice
+        pad: number of samples of silence between intervals
+        final: whether these are the last intervals
+
+    Returns:
+        the slices, flattened, and the number of intervals they contain
+    """
+
+    n = starts.shape[0]
+    piece_starts = np.empty(2 * n, np.int64)
+    piece_ends = np.empty(2 * n, np.int64)
+    offsets = np.zeros(n + 1, np.int64)
+    n_pieces, n_slices, consumed = 0, 0, 0
+    duration = 0.0
+
+    for i in range(n):
+        duration += (ends[i] - starts[i]) / rate
+        piece_starts[n_pieces] = starts[i]
+        piece_ends[n_pieces] = ends[i]
+        n_pieces += 1
+
+        if duration >= min_duration:
+            n_slices += 1
+            offsets[n_slices] = n_pieces
+            consumed = i + 1
+            duration = 0.0
+            continue
+
+        piece_starts[n_pieces] = -1
+        piece_ends[n_pieces] = pad
+        n_pieces += 1
+
+    if final and duration > 0:
+        n_slices += 1
+        offsets[n_slices] = n_pieces
+        consumed = n
+
+    n_pieces = offsets[n_slices]
+
+    return (
+        piece_starts[:n_pieces],
+        piece_ends[:n_pieces],
+        offsets[: n_slices + 1],
+        consumed,
+    )
+
+
+@jit
+def split_by_max_duration_kernel(starts, ends, offsets, max_samples):
+    """Evenly split the slices longer than max_samples
+
+    The loop of slice_pieces_by_max_duration, applied to every slice.
+
+    Args:
+        starts: start of each piece, -1 for padded silence
+        ends: end of each piece, or its length for padded silence
+        offsets: offset of the first piece of each slice
+        max_samples: maximum number of samples of a slice, as a float
+
+    Returns:
+        the split slices, flattened
+    """
+
+    n_slices = offsets.shape[0] - 1
+    lengths = np.where(starts < 0, ends, ends - starts)
+    totals = np.zeros(n_slices, np.int64)
+    n_chunks = np.ones(n_slices, np.int64)
+
+    for s in range(n_slices):
+        for p in range(offsets[s], offsets[s + 1]):
+            totals[s] += lengths[p]
+
+        if totals[s] > max_samples:
+            n_chunks[s] = int(np.ceil(totals[s] / max_samples))
+
+    # Each piece is emitted once, plus once more for every chunk boundary inside it
+    size = starts.shape[0] + n_chunks.sum()
+    out_starts = np.empty(size, np.int64)
+    out_ends = np.empty(size, np.int64)
+    out_offsets = np.zeros(n_chunks.sum() + 1, np.int64)
+    n_out, n_slices_out = 0, 0
+
+    for s in range(n_slices):
+        if totals[s] <= max_samples:
+            for p in range(offsets[s], offsets[s + 1]):
+                out_starts[n_out] = starts[p]
+                out_ends[n_out] = ends[p]
+                n_out += 1
+
+            n_slices_out += 1
+            out_offsets[n_slices_out] = n_out
+            continue
+
+        chunk_size = int(np.ceil(totals[s] / n_chunks[s]))
+        remaining = chunk_size
+        chunk_pieces = 0
+
+        for p in range(offsets[s], offsets[s + 1]):
+            offset = 0
+
+            while lengths[p] - offset > 0:
+                taken = min(remaining, lengths[p] - offset)
+
+                if starts[p] < 0:
+                    out_starts[n_out] = -1
+                    out_ends[n_out] = taken
+                else:
+                    out_starts[n_out] = starts[p] + offset
+                    out_ends[n_out] = starts[p] + offset + taken
+
+                n_out += 1
+                chunk_pieces += 1
+                offset += taken
+                remaining -= taken
+
+                if remaining == 0:
+                    n_slices_out += 1
+                    out_offsets[n_slices_out] = n_out
+                    remaining = chunk_size
+                    chunk_pieces = 0
+
+        if chunk_pieces > 0:
+            n_slices_out += 1
+            out_offsets[n_slices_out] = n_out
+
+    return out_starts[:n_out], out_ends[:n_out], out_offsets[: n_slices_out + 1]
@@ -0,0 +1,116 @@
+import json
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
+
+MANIFEST_FORMATS = ("jsonl", "parquet")
+
+
+def slice_records(
+    source: Union[str, Path],
+    rate: int,
+    slices: Iterable[list[tuple[Optional[int], int]]],
+) -> list[dict]:
+    """Describe planned slices as manifest records, without reading any audio
+
+    Args:
+        source: source audio file
+        rate: sample rate of the source
+        slices: pieces of each slice, (start, end) ranges of source samples or
+            (None, length) of silence
+
+    Returns:
+        one record per slice
+    """
+
+    records = []
+
+    for idx, pieces in enumerate(slices):
+        # Plans may hold numpy integers, which json can't serialize
+        pieces = [
+            (None if start is None else int(start), int(end)) for start, end in pieces
+        ]
+        ranges = [(start, end) for start, end in pieces if start is not None]
+        length = sum(end - start if start is not None else end for start, end in pieces)
+
+        records.append(
+            {
+                "source": str(source),
+                "index": idx,
+                "sample_rate": int(rate),
+                "start": ranges[0][0] if ranges else 0,
+                "end": ranges[-1][1] if ranges else 0,
+                "duration": length / rate,
+                "segments": [[start, end] for start, end in pieces],
+            }
+        )
+
+    return records
+
+
+def write_manifest(path: Union[str, Path], records: list[dict]) -> None:
+    """Write manifest records, as JSONL or Parquet depending on the suffix
+
+    Args:
+        path: output file, ending with .jsonl or .parquet
+        records: manifest records
+    """
+
+    path = Path(path)
+
+    if path.suffix == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing parquet manifests requires pyarrow")
+
+        pq.write_table(pa.Table.from_pylist(records), str(path))
+        return
+
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def read_manifest(path: Union[str, Path]) -> list[dict]:
+    """Read manifest records written by write_manifest
+
+    Args:
+        path: manifest file, ending with .jsonl or .parquet
+
+    Returns:
+        manifest records
+    """
+
+    path = Path(path)
+
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        return pq.read_table(str(path)).to_pylist()
+
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_slice(record: dict, mono: bool = True) -> tuple[np.ndarray, int]:
+    """Lazily load one slice of a manifest, seeking into its source file
+
+    Args:
+        record: manifest record
+        mono: downmix to mono, like the slicers do
+
+    Returns:
+        audio data and sample rate
+    """
+
+    import soundfile as sf
+
+    from fish_audio_preprocess.utils.slice_audio import read_pieces
+
+    pieces = [(start, end) for start, end in record["segments"]]
+
+    with sf.SoundFile(str(record["source"])) as f:
+        return read_pieces(f, pieces, mono=mono), f.samplerate
@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import soundfile as sf
+
+
+def probe_audio(path: Union[str, Path]) -> tuple[int, int, int]:
+    """Read the length, sample rate and channels of an audio file from its header
+
+    Args:
+        path: audio file
+
+    Returns:
+        number of samples, sample rate and number of channels
+    """
+
+    try:
+        info = sf.info(str(path))
+
+        return info.frames, info.samplerate, info.channels
+    except RuntimeError:
+        # Not readable by soundfile, fall back to librosa, which has to decode it
+        import librosa
+
+        audio, rate = librosa.load(str(path), sr=None, mono=False)
+
+        return audio.shape[-1], rate, 1 if audio.ndim == 1 else audio.shape[0]
+
+
+def read_audio(path: Union[str, Path]) -> tuple[np.ndarray, int]:
+    """Read an audio file, in shape (samples, channels)
+
+    Args:
+        path: audio file
+
+    Returns:
+        audio data and sample rate
+    """
+
+    try:
+        return sf.read(str(path), dtype="float32", always_2d=True)
+    except RuntimeError:
+        import librosa
+
+        audio, rate = librosa.load(str(path), sr=None, mono=False)
+
+        return audio.reshape(-1, audio.shape[-1]).T, rate
+
+
+def pack_bins(lengths: list[int], capacity: int) -> list[list[int]]:
+    """First-fit decreasing bin packing
+
+    Items are placed from the longest to the shortest, each in the first bin with
+    enough room left, found in O(log bins) with a segment tree over the room left
+    in each bin. Items longer than the capacity get a bin of their own.
+
+    Args:
+        lengths: length of each item
+        capacity: capacity of each bin
+
+    Returns:
+        indices of the items of each bin, in ascending order
+    """
+
+    order = sorted(range(len(lengths)), key=lambda idx: -lengths[idx])
+
+    # There are never more bins than items
+    size = 1
+    while size < len(lengths):
+        size *= 2
+
+    # Leaves are the room left in each bin, bins not opened yet have full room,
+    # so the first bin with enough room is at most the next one to open
+    tree = [capacity] * (2 * size)
+    bins = []
+
+    for idx in order:
+        length = lengths[idx]
+
+        if length > capacity:
+            node = size + len(bins)
+        else:
+            node = 1
+            while node < size:
+                node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+
+        if node - size == len(bins):
+            bins.append([])
+
+        bins[node - size].append(idx)
+        tree[node] = max(tree[node] - length, 0)
+
+        while node > 1:
+            node //= 2
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+
+    return [sorted(items) for items in bins]
+
+
+def merge_files(
+    sources: list[Union[str, Path]],
+    output_file: Union[str, Path],
+    rate: int,
+    channels: int,
+    resampler: str = "soxr_hq",
+) -> None:
+    """Concatenate audio files into one, holding one source in memory at a time
+
+    Args:
+        sources: audio files, with the same channels
+        output_file: output audio file
+        rate: sample rate of the output, sources at other rates are resampled
+        channels: number of channels of the sources
+        resampler: one of RESAMPLERS, used for sources at other rates
+    """
+
+    from fish_audio_preprocess.utils.resample import resample_audio
+
+    with sf.SoundFile(str(output_file), "w", samplerate=rate, channels=channels) as f:
+        for source in sources:
+            audio, sr = read_audio(source)
+            f.write(resample_audio(audio, sr, rate, resampler))
@@ -0,0 +1,217 @@
+import os
+from contextlib import ExitStack
+from functools import lru_cache
+from math import gcd
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from loguru import logger
+
+# Names follow librosa's `res_type` naming where they overlap
+SOXR_QUALITIES = {
+    "soxr_vhq": "VHQ",
+    "soxr_hq": "HQ",
+    "soxr_mq": "MQ",
+    "soxr_lq": "LQ",
+    "soxr_qq": "QQ",
+}
+
+RESAMPLERS = (*SOXR_QUALITIES.keys(), "polyphase", "integer")
+
+
+@lru_cache(maxsize=None)
+def _polyphase_kernel(
+    orig_sr: int, target_sr: int, half_len_factor: int = 10, beta: float = 5.0
+) -> tuple[int, int, np.ndarray]:
+    """Design (once per rate pair) the low-pass FIR used by the polyphase resampler
+
+    Args:
+        orig_sr: original sample rate
+        target_sr: target sample rate
+        half_len_factor: half length of the filter, in units of max(up, down)
+        beta: beta of the kaiser window
+
+    Returns:
+        up, down and the filter coefficients
+    """
+
+    from scipy.signal import firwin
+
+    ratio = gcd(orig_sr, target_sr)
+    up, down = target_sr // ratio, orig_sr // ratio
+    max_rate = max(up, down)
+
+    # Same design as scipy.signal.resample_poly's default
+    kernel = firwin(
+        2 * half_len_factor * max_rate + 1, 1.0 / max_rate, window=("kaiser", beta)
+    )
+    kernel.setflags(write=False)
+
+    return up, down, kernel
+
+
+def resample_audio(
+    audio: np.ndarray, orig_sr: int, target_sr: int, resampler: str = "soxr_hq"
+) -> np.ndarray:
+    """Resample audio with the selected backend
+
+    Args:
+        audio: audio data, in shape (samples,) or (samples, channels)
+        orig_sr: original sample rate
+        target_sr: target sample rate
+        resampler: one of RESAMPLERS
+
+    Returns:
+        resampled audio, in the same layout and dtype as the input
+    """
+
+    if resampler not in RESAMPLERS:
+        raise ValueError(f"Unknown resampler {resampler}, expected one of {RESAMPLERS}")
+
+    if orig_sr == target_sr:
+        return audio
+
+    if resampler in SOXR_QUALITIES:
+        import soxr
+
+        return soxr.resample(
+            audio, orig_sr, target_sr, quality=SOXR_QUALITIES[resampler]
+        )
+
+    from scipy.signal import resample_poly
+
+    if resampler == "integer":
+        if orig_sr % target_sr == 0 or target_sr % orig_sr == 0:
+            # Trade some quality for speed with a shorter filter
+            up, down, kernel = _polyphase_kernel(orig_sr, target_sr, 6, 6.0)
+        else:
+            logger.debug(
+                f"{orig_sr} -> {target_sr} Hz is not an integer ratio, "
+                "falling back to polyphase"
+            )
+            up, down, kernel = _polyphase_kernel(orig_sr, target_sr)
+    else:
+        up, down, kernel = _polyphase_kernel(orig_sr, target_sr)
+
+    resampled = resample_poly(audio, up, down, axis=0, window=kernel)
+
+    return resampled.astype(audio.dtype, copy=False)
+
+
+def is_target_format(
+    info, output_file: Union[str, Path], target_sr: int, mono: bool = True
+) -> bool:
+    """Check from the header whether resampling would reproduce the input file
+
+    Args:
+        info: header of the input file, as returned by soundfile.info
+        output_file: output audio file
+        target_sr: target sample rate
+        mono: downmix to mono
+
+    Returns:
+        True if rate, channels, format and subtype already match the output
+    """
+
+    import soundfile as sf
+
+    return (
+        info.samplerate == target_sr
+        and (info.channels == 1 or not mono)
+        and info.format == Path(output_file).suffix[1:].upper()
+        and info.subtype == sf.default_subtype(info.format)
+    )
+
+
+def resample_file_streaming(
+    input_file: Union[str, Path],
+    targets: dict[int, Union[str, Path]],
+    mono: bool = True,
+    resampler: str = "soxr_hq",
+    block_size: int = 65536,
+) -> None:
+    """Resample a file block by block, keeping memory bounded by block_size
+
+    Every block is decoded once and fed to one resampler per target rate. The soxr
+    filter state is carried across blocks, so the output matches resample_audio on
+    the whole file. Each output is written to a temporary file next to it and
+    moved in place once the input is fully read, so an output may be its input.
+
+    Args:
+        input_file: input audio file, must be readable by soundfile
+        targets: output audio file of each target sample rate
+        mono: downmix to mono
+        resampler: one of SOXR_QUALITIES, other backends can't stream
+        block_size: number of frames decoded at a time
+    """
+
+    import soundfile as sf
+    import soxr
+
+    if resampler not in SOXR_QUALITIES:
+        raise ValueError(
+            f"Resampler {resampler} can't stream, expected one of {tuple(SOXR_QUALITIES)}"
+        )
+
+    info = sf.info(str(input_file))
+    channels = 1 if mono else info.channels
+
+    temps = {
+        target_sr: Path(output_file).with_name(
+            f"{Path(output_file).name}.{os.getpid()}.tmp"
+        )
+        for target_sr, output_file in targets.items()
+    }
+
+    try:
+        with ExitStack() as stack:
+            outputs = []
+
+            for target_sr, output_file in targets.items():
+                stream = None
+
+                if info.samplerate != target_sr:
+                    stream = soxr.ResampleStream(
+                        info.samplerate,
+                        target_sr,
+                        channels,
+                        dtype="float32",
+                        quality=SOXR_QUALITIES[resampler],
+                    )
+
+                # The format can't be guessed from the temporary name
+                f = sf.SoundFile(
+                    str(temps[target_sr]),
+                    "w",
+                    samplerate=target_sr,
+                    channels=channels,
+                    format=Path(output_file).suffix[1:].upper(),
+                )
+                outputs.append((stack.enter_context(f), stream))
+
+            for block in sf.blocks(
+                str(input_file), blocksize=block_size, dtype="float32", always_2d=True
+            ):
+                if mono:
+                    block = block.mean(axis=1, keepdims=True)
+
+                for f, stream in outputs:
+                    f.write(block if stream is None else stream.resample_chunk(block))
+
+            for f, stream in outputs:
+                if stream is not None:
+                    # Flush the samples still held by the filter
+                    f.write(
+                        stream.resample_chunk(
+                            np.zeros((0, channels), np.float32), last=True
+                        )
+                    )
+    except BaseException:
+        for tmp in temps.values():
+            tmp.unlink(missing_ok=True)
+
+        raise
+
+    for target_sr, output_file in targets.items():
+        os.replace(temps[target_sr], output_file)
@@ -1,6 +1,9 @@
+import os
+from contextlib import ExitStack
 from pathlib import Path
 from typing import Optional, Union
 
+import numpy as np
 import torch
 from demucs.apply import BagOfModels, apply_model
 from demucs.audio import save_audio as _save_audio
@@ -8,11 +11,138 @@ from demucs.pretrained import get_model
 from demucs.separate import load_track as _load_track
 from loguru import logger
 
+from fish_audio_preprocess.utils.cache import (
+    array_digest,
+    cache_file,
+    load_npz,
+    save_npz,
+)
+
+# fp32: float32 weights, bf16: bfloat16 convolutions and linear layers,
+# int8: dynamically quantized linear and LSTM layers, CPU only
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+# Formats written by save_audio
+SAVE_EXTENSIONS = (".wav", ".flac", ".mp3")
+
+# Layers computed in bfloat16 with the bf16 precision
+_BF16_LAYERS = (
+    torch.nn.Conv1d,
+    torch.nn.Conv2d,
+    torch.nn.ConvTranspose1d,
+    torch.nn.ConvTranspose2d,
+    torch.nn.Linear,
+    torch.nn.MultiheadAttention,
+)
+
+
+def _to_bf16(model: torch.nn.Module) -> None:
+    """
+    Compute the heavy layers of a model in bfloat16
+
+    The spectrogram and complex operations of Demucs have no bfloat16 kernels, so
+    the model can't run under a global autocast. Instead the weights of each
+    convolution, linear and attention layer are cast to bfloat16, and their inputs
+    and outputs are cast on the fly, the rest of the model stays in float32.
+
+    Args:
+        model: The model, modified in place
+    """
+
+    def cast_inputs(module, args, kwargs):
+        return (
+            tuple(cast(arg, torch.bfloat16) for arg in args),
+            {key: cast(value, torch.bfloat16) for key, value in kwargs.items()},
+        )
+
+    def cast_outputs(module, args, output):
+        if isinstance(output, tuple):
+            return tuple(cast(item, torch.float32) for item in output)
+
+        return cast(output, torch.float32)
+
+    def cast(value, dtype):
+        if isinstance(value, torch.Tensor) and value.is_floating_point():
+            return value.to(dtype)
+
+        return value
+
+    for module in model.modules():
+        if isinstance(module, _BF16_LAYERS):
+            module.to(torch.bfloat16)
+            module.register_forward_pre_hook(cast_inputs, with_kwargs=True)
+            module.register_forward_hook(cast_outputs)
+
+
+# Rough upper estimate of the peak activation memory of a Demucs forward, in
+# bytes per sample of segment and per item of the batch
+ACTIVATION_BYTES = 8192
+
+
+def set_segment(model: torch.nn.Module, segment: float) -> None:
+    """
+    Set the split size of each chunk of the model
+
+    Args:
+        model: The model
+        segment: Split size, in seconds
+    """
+
+    if isinstance(model, BagOfModels):
+        for m in model.models:
+            m.segment = segment
+    else:
+        model.segment = segment
+
+
+def plan_memory(model: torch.nn.Module, max_memory: float) -> tuple[float, float, int]:
+    """
+    Pick the segment, overlap and chunk length fitting in a memory budget
+
+    Half of the budget left by the weights goes to the activations of one
+    segment, shortened from the default of the model if needed, with a larger
+    overlap to make up for the shorter context. The rest holds a chunk of the
+    input, the output of apply_model and of each model of a bag, and the tracks,
+    all in float32. Longer inputs are separated chunk by chunk, see
+    separate_audio_streamed, but are still decoded whole, on top of the budget.
+    Batches decoded ahead of the model are not counted either, the caller has
+    to decode one batch at a time.
+
+    Args:
+        model: The model
+        max_memory: Memory budget, in bytes
+
+    Returns:
+        Segment in seconds, overlap, and maximum samples separated at once
+    """
+
+    models = model.models if isinstance(model, BagOfModels) else [model]
+    weights = sum(p.numel() * p.element_size() for p in model.parameters())
+    budget = max_memory - weights
+    full = min(float(m.segment) for m in models)
+    segment = min(full, budget / 2 / (ACTIVATION_BYTES * model.samplerate))
+
+    if segment < 1:
+        needed = weights + 2 * ACTIVATION_BYTES * model.samplerate
+        raise ValueError(
+            f"A memory budget of {max_memory / 2**30:.2f} GB is too small, "
+            f"at least {needed / 2**30:.2f} GB is needed"
+        )
+
+    overlap = min(0.5, 0.25 * full / segment)
+    per_sample = 4 * model.audio_channels * (1 + 3 * len(model.sources))
+    chunk = int((budget - segment * model.samplerate * ACTIVATION_BYTES) / per_sample)
+
+    # Chunks are cross-faded over one segment, see separate_audio_streamed
+    return segment, overlap, max(chunk, int(4 * segment * model.samplerate))
+
 
 def init_model(
     name: str = "htdemucs",
     device: Optional[Union[str, torch.device]] = None,
     segment: Optional[int] = None,
+    precision: str = "fp32",
+    compile_model: bool = False,
 ) -> torch.nn.Module:
     """
     Initialize the model
@@ -21,11 +151,16 @@ def init_model(
         name: Name of the model
         device: Device to use
         segment: Set split size of each chunk. This can help save memory of graphic card.
+        precision: One of PRECISIONS
+        compile_model: Compile the forward of each model with torch.compile
 
     Returns:
         The model
     """
 
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
     model = get_model(name)
     model.eval()
 
@@ -41,11 +176,68 @@ def init_model(
         )
 
     if segment is not None:
-        if isinstance(model, BagOfModels):
-            for m in model.models:
-                m.segment = segment
-        else:
-            model.segment = segment
+        set_segment(model, segment)
+
+    return optimize_model(model, precision, compile_model)
+
+
+def optimize_model(
+    model: torch.nn.Module, precision: str = "fp32", compile_model: bool = False
+) -> torch.nn.Module:
+    """
+    Set the precision of a loaded model and compile it, see init_model
+
+    Args:
+        model: The model, modified in place
+        precision: One of PRECISIONS
+        compile_model: Compile the forward of each model with torch.compile
+
+    Returns:
+        The model
+    """
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
+    device = next(model.parameters()).device
+
+    if precision == "int8" and device.type != "cpu":
+        raise ValueError("int8 precision is only supported on CPU")
+
+    # Forward hooks with kwargs and torch.compile appeared in torch 2.0
+    if (precision == "bf16" or compile_model) and int(
+        torch.__version__.split(".")[0]
+    ) < 2:
+        raise RuntimeError(
+            f"bf16 precision and compilation require torch>=2.0, "
+            f"found {torch.__version__}"
+        )
+
+    models = model.models if isinstance(model, BagOfModels) else [model]
+
+    if precision == "bf16":
+        if device.type == "cpu" and not (
+            torch.backends.mkldnn.is_available()
+            and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        ):
+            logger.warning("This CPU has no native bfloat16 support, bf16 will be slow")
+
+        for m in models:
+            _to_bf16(m)
+    elif precision == "int8":
+        for m in models:
+            torch.ao.quantization.quantize_dynamic(
+                m, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True
+            )
+
+    if compile_model:
+        # apply_model dispatches on the class of the models, so only their
+        # forward is compiled, the modules themselves are kept
+        for m in models:
+            m.forward = torch.compile(m.forward)
+
+    if precision != "fp32" or compile_model:
+        logger.info(f"Model runs in {precision}, compiled: {compile_model}")
 
     return model
 
@@ -89,25 +281,211 @@ def separate_audio(
         The separated tracks
     """
 
+    return separate_audio_batch(
+        model, [audio], shifts=shifts, num_workers=num_workers, progress=progress
+    )[0]
+
+
+def separate_audio_batch(
+    model: torch.nn.Module,
+    audios: list[torch.Tensor],
+    shifts: int = 1,
+    num_workers: int = 0,
+    progress: bool = False,
+    regions: Optional[list[list[tuple[int, int]]]] = None,
+    overlap: float = 0.25,
+) -> list[dict[str, torch.Tensor]]:
+    """
+    Separate several audios with shared model forwards
+
+    Each audio is normalized on its own, then they are zero padded to the same
+    length and stacked on the batch dimension, so every segment forward of the
+    model processes all of them at once. The padding is cut from the results.
+
+    With regions, only those parts of each audio go through the model, as items
+    of the batch, and the tracks are silent elsewhere. The items are grouped by
+    length, at most len(audios) per forward.
+
+    Args:
+        model: The model
+        audios: The audios, with the same number of channels
+        shifts: Run the model N times, larger values will increase the quality but also the time
+        num_workers: Number of workers to use
+        progress: Show progress bar
+        regions: (start, end) samples to separate of each audio, see active_regions,
+            the whole audios if None
+        overlap: Overlap between the segments of the model
+
+    Returns:
+        The separated tracks of each audio
+    """
+
     device = next(model.parameters()).device
 
-    ref = audio.mean(0)
-    audio = (audio - ref.mean()) / audio.std()
+    if regions is None:
+        regions = [[(0, audio.shape[-1])] for audio in audios]
+
+    # Parts of the audios separated by the model, longest first
+    pieces = sorted(
+        (
+            (idx, start, end)
+            for idx, audio_regions in enumerate(regions)
+            for start, end in audio_regions
+        ),
+        key=lambda piece: piece[1] - piece[2],
+    )
+    refs = [audio.mean(0) for audio in audios]
+    outputs = [audio.new_zeros(len(model.sources), *audio.shape) for audio in audios]
+
+    for first in range(0, len(pieces), len(audios)):
+        group = pieces[first : first + len(audios)]
+        length = group[0][2] - group[0][1]
+        batch = audios[0].new_zeros(len(group), audios[0].shape[0], length)
+
+        for item, (idx, start, end) in enumerate(group):
+            audio = audios[idx]
+            batch[item, :, : end - start] = (
+                audio[:, start:end] - refs[idx].mean()
+            ) / audio.std()
+
+        with torch.inference_mode():
+            sources = apply_model(
+                model,
+                batch,
+                device=device,
+                shifts=shifts,
+                split=True,
+                overlap=overlap,
+                progress=progress,
+                num_workers=num_workers,
+            )
+
+        for item, (idx, start, end) in enumerate(group):
+            outputs[idx][..., start:end] = sources[item, ..., : end - start].to(
+                outputs[idx]
+            )
+
+    return [
+        dict(zip(model.sources, output * ref.std() + ref.mean()))
+        for output, ref in zip(outputs, refs)
+    ]
+
+
+def separate_audio_streamed(
+    model: torch.nn.Module,
+    audio: torch.Tensor,
+    outputs: list[tuple[Union[str, Path], list[str]]],
+    chunk: int,
+    shifts: int = 1,
+    overlap: float = 0.25,
+) -> None:
+    """
+    Separate a long audio chunk by chunk, writing the merged tracks as they come
 
-    sources = apply_model(
-        model,
-        audio[None],
-        device=device,
-        shifts=shifts,
-        split=True,
-        overlap=0.25,
-        progress=progress,
-        num_workers=num_workers,
-    )[0]
+    Only one chunk of tracks is held in memory. The audio is normalized as a
+    whole, consecutive chunks overlap by one segment of the model, and are
+    cross-faded there. Samples out of [-1, 1] are clamped, since the tracks
+    can't be rescaled as a whole like save_audio does.
 
-    sources = sources * ref.std() + ref.mean()
+    WAV and FLAC outputs are written by soundfile directly. Other formats go to
+    a temporary WAV first, which is then encoded by save_audio, so it is read
+    back whole.
 
-    return dict(zip(model.sources, sources))
+    Args:
+        model: The model
+        audio: The audio
+        outputs: Path and stems of each merged track, see merge_tracks
+        chunk: Samples separated at once, see plan_memory
+        shifts: Run the model N times, larger values will increase the quality but also the time
+        overlap: Overlap between the segments of the model
+    """
+
+    import soundfile as sf
+
+    device = next(model.parameters()).device
+    models = model.models if isinstance(model, BagOfModels) else [model]
+    fade = int(min(float(m.segment) for m in models) * model.samplerate)
+    hop = chunk - fade
+    ref = audio.mean(0)
+    mean, std = ref.mean(), ref.std()
+    scale = audio.std()
+    length = audio.shape[-1]
+
+    # Fail before the separation, which may take a while
+    for path, _ in outputs:
+        if Path(path).suffix.lower() not in SAVE_EXTENSIONS:
+            raise ValueError(f"Can't write {path}, expected one of {SAVE_EXTENSIONS}")
+
+    paths = [
+        (
+            Path(path)
+            if Path(path).suffix.lower() in (".wav", ".flac")
+            else Path(path).with_name(f"{Path(path).name}.{os.getpid()}.tmp.wav")
+        )
+        for path, _ in outputs
+    ]
+    files = []
+
+    def write(tracks):
+        tracks = dict(zip(model.sources, tracks * std + mean))
+
+        for f, (_, stems) in zip(files, outputs):
+            merged = merge_tracks(tracks, stems).clamp_(-1, 1)
+            f.write(merged.T.cpu().numpy())
+
+    try:
+        with ExitStack() as stack:
+            for path in paths:
+                files.append(
+                    stack.enter_context(
+                        sf.SoundFile(
+                            str(path),
+                            "w",
+                            samplerate=model.samplerate,
+                            channels=audio.shape[0],
+                            subtype="PCM_16",
+                        )
+                    )
+                )
+
+            tail = None
+
+            for start in range(0, length, hop):
+                end = min(start + chunk, length)
+
+                # The cross-fade updates the tracks in place, inside inference
+                # mode too
+                with torch.inference_mode():
+                    tracks = apply_model(
+                        model,
+                        ((audio[:, start:end] - mean) / scale)[None],
+                        device=device,
+                        shifts=shifts,
+                        split=True,
+                        overlap=overlap,
+                    ).to(audio)[0]
+
+                    if tail is not None:
+                        weight = torch.linspace(0, 1, fade, dtype=tracks.dtype)
+                        tracks[..., :fade] = (
+                            tail * (1 - weight) + tracks[..., :fade] * weight
+                        )
+
+                    if end == length:
+                        write(tracks)
+                        break
+
+                    write(tracks[..., :-fade])
+                    tail = tracks[..., -fade:].clone()
+
+        for path, (output, _) in zip(paths, outputs):
+            if path != Path(output):
+                track = sf.read(str(path), dtype="float32", always_2d=True)[0]
+                save_audio(model, output, torch.from_numpy(track.T))
+    finally:
+        for path, (output, _) in zip(paths, outputs):
+            if path != Path(output):
+                path.unlink(missing_ok=True)
 
 
 def save_audio(
@@ -161,6 +539,100 @@ def merge_tracks(
     return merged
 
 
+def tracks_cache_file(
+    cache_dir: Union[str, Path],
+    model: torch.nn.Module,
+    name: str,
+    audio: torch.Tensor,
+    shifts: int = 1,
+    precision: str = "fp32",
+    silence_db: Optional[float] = None,
+    overlap: float = 0.25,
+    noise_db: Optional[float] = None,
+    noise_flatness: float = 0.3,
+) -> Path:
+    """
+    Path of the cached tracks of an audio
+
+    The key is the decoded audio itself, so a file renamed, moved or exported
+    again with the same content hits the cache.
+
+    Args:
+        cache_dir: The cache directory
+        model: The model
+        name: Name of the model
+        audio: The audio, as returned by load_track
+        shifts: Number of shifts
+        precision: Precision of the model, see PRECISIONS
+        silence_db: Level of the silence screen, None if it is off
+        overlap: Overlap between the segments of the model
+        noise_db: Level of the noise floor screen, None if it is off
+        noise_flatness: Spectral flatness of the noise floor screen
+
+    Returns:
+        Path to the entry, which may not exist yet
+    """
+
+    segments = [
+        getattr(m, "segment", None)
+        for m in (model.models if isinstance(model, BagOfModels) else [model])
+    ]
+
+    return cache_file(
+        cache_dir,
+        "separate",
+        array_digest(audio.cpu().numpy()),
+        name,
+        shifts,
+        segments,
+        precision,
+        silence_db,
+        overlap,
+        None if noise_db is None else (noise_db, noise_flatness),
+    )
+
+
+def save_cached_tracks(path: Union[str, Path], tracks: dict[str, torch.Tensor]):
+    """
+    Save separated tracks to the cache, in float16 and compressed
+
+    Args:
+        path: Path to the entry
+        tracks: The separated tracks
+    """
+
+    save_npz(
+        path,
+        compress=True,
+        **{
+            name: track.cpu().numpy().astype(np.float16)
+            for name, track in tracks.items()
+        },
+    )
+
+
+def load_cached_tracks(path: Union[str, Path]) -> Optional[dict[str, torch.Tensor]]:
+    """
+    Load separated tracks from the cache
+
+    Args:
+        path: Path to the entry
+
+    Returns:
+        The separated tracks, or None if the entry is missing or unreadable
+    """
+
+    arrays = load_npz(path)
+
+    if arrays is None:
+        return None
+
+    return {
+        name: torch.from_numpy(array.astype(np.float32))
+        for name, array in arrays.items()
+    }
+
+
 if __name__ == "__main__":
     model = init_model("htdemucs", device="cuda:0")
 
@@ -1,11 +1,23 @@
 import math
+from concurrent.futures import Executor
+from itertools import islice
 from pathlib import Path
-from typing import Iterable, Union
+from typing import Iterable, Iterator, Optional, Union
 
 import librosa
 import numpy as np
 import soundfile as sf
 
+from fish_audio_preprocess.utils.energy import BLOCK_FRAMES, frame_power
+from fish_audio_preprocess.utils.kernels import (
+    get_backend,
+    group_intervals_kernel,
+    split_by_max_duration_kernel,
+    unflatten_slices,
+)
+from fish_audio_preprocess.utils.manifest import slice_records
+from fish_audio_preprocess.utils.writer import write_slices_to
+
 
 def slice_by_max_duration(
     gen: np.ndarray, slice_max_duration: float, rate: int
@@ -32,6 +44,165 @@ def slice_by_max_duration(
         yield gen
 
 
+def slice_pieces_by_max_duration(
+    pieces: list[tuple[Optional[int], int]], slice_max_duration: float, rate: int
+) -> Iterable[list[tuple[Optional[int], int]]]:
+    """Same as slice_by_max_duration, on a slice described by its pieces
+
+    Args:
+        pieces: (start, end) ranges of source samples, or (None, length) of silence
+        slice_max_duration: maximum duration of each slice
+        rate: sample rate
+
+    Returns:
+        generator of the pieces of each slice
+    """
+
+    lengths = [end - start if start is not None else end for start, end in pieces]
+    total = sum(lengths)
+
+    if total <= slice_max_duration * rate:
+        yield pieces
+        return
+
+    n_chunks = math.ceil(total / (slice_max_duration * rate))
+    chunk_size = math.ceil(total / n_chunks)
+    chunk, remaining = [], chunk_size
+
+    for (start, end), length in zip(pieces, lengths):
+        offset = 0
+
+        while length - offset > 0:
+            taken = min(remaining, length - offset)
+
+            if start is None:
+                chunk.append((None, taken))
+            else:
+                chunk.append((start + offset, start + offset + taken))
+
+            offset += taken
+            remaining -= taken
+
+            if remaining == 0:
+                yield chunk
+                chunk, remaining = [], chunk_size
+
+    if len(chunk) > 0:
+        yield chunk
+
+
+# Non-silent intervals grouped per call of the numba kernel of plan_slices
+INTERVAL_BLOCK = 256
+
+
+def plan_slices(
+    intervals: Iterable[tuple[int, int]],
+    n_samples: int,
+    rate: int,
+    min_duration: float = 6.0,
+    max_duration: float = 30.0,
+    pad_silence: float = 0.4,
+) -> Iterator[list[tuple[Optional[int], int]]]:
+    """Plan the slices of slice_audio from the non-silent intervals
+
+    Args:
+        intervals: (start, end) non-silent intervals, in samples, only consumed
+            if the audio is longer than min_duration
+        n_samples: number of samples of the audio
+        rate: sample rate
+        min_duration: minimum duration of each slice
+        max_duration: maximum duration of each slice
+        pad_silence: pad silence between each non-silent slice
+
+    Returns:
+        generator of slices, each as a list of pieces: (start, end) ranges of
+        source samples, or (None, length) of padded silence
+    """
+
+    if n_samples / rate < min_duration:
+        yield from slice_pieces_by_max_duration([(0, n_samples)], max_duration, rate)
+        return
+
+    if get_backend() == "numba":
+        # Intervals are consumed block by block, so slices are still emitted
+        # while a stream is decoded, the intervals of an unfinished slice are
+        # carried over to the next block
+        intervals = iter(intervals)
+        carry = np.empty((0, 2), dtype=np.int64)
+        final = False
+
+        while not final:
+            block = np.array(list(islice(intervals, INTERVAL_BLOCK)), dtype=np.int64)
+            final = len(block) < INTERVAL_BLOCK
+            block = np.concatenate([carry, block.reshape(-1, 2)])
+            *slices, consumed = group_intervals_kernel(
+                block[:, 0],
+                block[:, 1],
+                rate,
+                min_duration,
+                int(rate * pad_silence),
+                final,
+            )
+            yield from unflatten_slices(
+                *split_by_max_duration_kernel(*slices, max_duration * rate)
+            )
+            carry = block[consumed:]
+
+        return
+
+    pieces, duration = [], 0
+
+    for start, end in intervals:
+        duration += (end - start) / rate
+        pieces.append((start, end))
+
+        if duration >= min_duration:
+            yield from slice_pieces_by_max_duration(pieces, max_duration, rate)
+            pieces, duration = [], 0
+            continue
+
+        pieces.append((None, int(rate * pad_silence)))
+
+    if duration > 0:
+        yield from slice_pieces_by_max_duration(pieces, max_duration, rate)
+
+
+def take_pieces(
+    audio: np.ndarray, pieces: list[tuple[Optional[int], int]]
+) -> np.ndarray:
+    """Assemble a slice described by its pieces from in-memory audio
+
+    Contiguous pieces are returned as a view, others are copied once into a
+    preallocated buffer.
+
+    Args:
+        audio: audio data, in shape (samples, channels)
+        pieces: (start, end) ranges of samples, or (None, length) of silence
+
+    Returns:
+        the slice
+    """
+
+    if all(start is not None for start, _ in pieces) and all(
+        start == end for (_, end), (start, _) in zip(pieces[:-1], pieces[1:])
+    ):
+        return audio[pieces[0][0] : pieces[-1][1]]
+
+    lengths = [end - start if start is not None else end for start, end in pieces]
+    sliced = np.empty((sum(lengths), *audio.shape[1:]), dtype=audio.dtype)
+    offset = 0
+
+    for (start, end), length in zip(pieces, lengths):
+        if start is None:
+            sliced[offset : offset + length] = 0
+        else:
+            sliced[offset : offset + length] = audio[start:end]
+
+        offset += length
+
+    return sliced
+
+
 def slice_audio(
     audio: np.ndarray,
     rate: int,
@@ -58,38 +229,377 @@ def slice_audio(
         Iterable of sliced audio
     """
 
-    if len(audio) / rate < min_duration:
-        yield from slice_by_max_duration(audio, max_duration, rate)
-        return
+    intervals = _nonsilent_intervals(
+        audio, top_db=top_db, frame_length=frame_length, hop_length=hop_length
+    )
 
-    intervals = librosa.effects.split(
-        audio.T, top_db=top_db, frame_length=frame_length, hop_length=hop_length
+    for pieces in plan_slices(
+        intervals, len(audio), rate, min_duration, max_duration, pad_silence
+    ):
+        yield take_pieces(audio, pieces)
+
+
+def _frame_power_blocks(
+    input_file: Union[str, Path],
+    frame_length: int = 2048,
+    hop_length: int = 512,
+    block_size: int = 262144,
+) -> Iterator[np.ndarray]:
+    """Mean power of the centered frames of a file, downmixed to mono, block by block
+
+    Returns exactly what frame_power gives on the whole file, but only keeps
+    BLOCK_FRAMES frames worth of samples in memory.
+
+    Args:
+        input_file: input audio file, must be readable by soundfile
+        frame_length: frame length
+        hop_length: hop length
+        block_size: number of samples decoded at a time
+
+    Returns:
+        generator of frame powers
+    """
+
+    # Frames are computed in the same groups as frame_power, so that the running
+    # sums, hence the results, are identical
+    group_length = (BLOCK_FRAMES - 1) * hop_length + frame_length
+
+    # Carries the samples of the next group, starts with the centering pad
+    buffer = np.zeros(frame_length // 2, dtype=np.float32)
+
+    for block in sf.blocks(
+        str(input_file), blocksize=block_size, dtype="float32", always_2d=True
+    ):
+        buffer = np.concatenate([buffer, block.mean(axis=1)])
+
+        while len(buffer) >= group_length:
+            yield frame_power(buffer[:group_length], frame_length, hop_length, False)
+            buffer = buffer[BLOCK_FRAMES * hop_length :]
+
+    buffer = np.concatenate([buffer, np.zeros(frame_length // 2, dtype=np.float32)])
+    power = frame_power(buffer, frame_length, hop_length, False)
+
+    if len(power) > 0:
+        yield power
+
+
+def _nonsilent_intervals_from_power(
+    powers: Iterable[np.ndarray], threshold: float, hop_length: int, total: int
+) -> Iterator[tuple[int, int]]:
+    """Turn frame powers into non-silent intervals, as soon as each of them ends
+
+    Args:
+        powers: frame powers, possibly split in consecutive blocks
+        threshold: power above which a frame is non-silent
+        hop_length: hop length of the frames
+        total: number of samples of the signal
+
+    Returns:
+        generator of (start, end) intervals, in samples
+    """
+
+    start, frame = None, 0
+
+    for power in powers:
+        non_silent = np.maximum(power, 1e-10) > threshold
+        edges = np.flatnonzero(np.diff(non_silent.astype(int), prepend=-1))
+
+        for edge in edges:
+            # The first edge of a block may just repeat the current state
+            if non_silent[edge] == (start is not None):
+                continue
+
+            if non_silent[edge]:
+                start = (frame + edge) * hop_length
+            else:
+                yield start, min((frame + edge) * hop_length, total)
+                start = None
+
+        frame += len(power)
+
+    if start is not None:
+        yield start, min(frame * hop_length, total)
+
+
+def _power_threshold(ref: float, top_db: int) -> float:
+    # Same as librosa.amplitude_to_db(rms, ref=np.max) > -top_db
+    return 10 ** (-top_db / 10) * max(ref, 1e-10)
+
+
+def _nonsilent_intervals(
+    audio: np.ndarray,
+    top_db: int = 60,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> Iterator[tuple[int, int]]:
+    """Equivalent of librosa.effects.split, on the running-sum frame power
+
+    Args:
+        audio: audio data, in shape (samples, channels)
+        top_db: top_db of librosa.effects.split
+        frame_length: frame_length of librosa.effects.split
+        hop_length: hop_length of librosa.effects.split
+
+    Returns:
+        generator of (start, end) intervals, in samples
+    """
+
+    channels = audio.reshape(len(audio), -1).T
+
+    # Like librosa, a frame is non-silent if any of the channels is
+    power = np.max(
+        [frame_power(channel, frame_length, hop_length) for channel in channels],
+        axis=0,
     )
 
-    arr, duration = [], 0
+    yield from _nonsilent_intervals_from_power(
+        [power], _power_threshold(power.max(), top_db), hop_length, len(audio)
+    )
 
-    for start, end in intervals:
-        time = (end - start) / rate
 
-        duration += time
-        arr.append(audio[start:end])
+def _nonsilent_intervals_stream(
+    input_file: Union[str, Path],
+    top_db: int = 60,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> Iterator[tuple[int, int]]:
+    """Streaming equivalent of _nonsilent_intervals, on the mono file
 
-        if duration >= min_duration:
-            _gen = np.concatenate(arr)
-            arr, duration = [], 0
-            yield from slice_by_max_duration(_gen, max_duration, rate)
-            continue
+    The file is decoded twice: once to find the reference (max) power, once to
+    emit the non-silent intervals as soon as they end.
 
-        if len(audio.shape) == 1:
-            silent_shape = int(rate * pad_silence)
-        else:
-            silent_shape = (int(rate * pad_silence), audio.shape[1])
+    Args:
+        input_file: input audio file, must be readable by soundfile
+        top_db: top_db of librosa.effects.split
+        frame_length: frame_length of librosa.effects.split
+        hop_length: hop_length of librosa.effects.split
+
+    Returns:
+        generator of (start, end) intervals, in samples
+    """
 
-        arr.append(np.zeros(silent_shape, dtype=audio.dtype))
+    ref = max(
+        (p.max() for p in _frame_power_blocks(input_file, frame_length, hop_length)),
+        default=0,
+    )
 
-    if duration > 0:
-        _gen = np.concatenate(arr)
-        yield from slice_by_max_duration(_gen, max_duration, rate)
+    yield from _nonsilent_intervals_from_power(
+        _frame_power_blocks(input_file, frame_length, hop_length),
+        _power_threshold(ref, top_db),
+        hop_length,
+        sf.info(str(input_file)).frames,
+    )
+
+
+def read_pieces(
+    f: sf.SoundFile, pieces: list[tuple[Optional[int], int]], mono: bool = True
+) -> np.ndarray:
+    """Read a slice described by its pieces, seeking to each of them
+
+    Args:
+        f: opened input file
+        pieces: (start, end) ranges of samples, or (None, length) of silence
+        mono: downmix to mono
+
+    Returns:
+        the slice, in shape (samples,) if mono else (samples, channels)
+    """
+
+    lengths = [end - start if start is not None else end for start, end in pieces]
+    audio = np.zeros((sum(lengths), f.channels), dtype=np.float32)
+    offset = 0
+
+    for (start, end), length in zip(pieces, lengths):
+        if start is not None:
+            f.seek(start)
+            f.read(
+                length,
+                dtype="float32",
+                always_2d=True,
+                out=audio[offset : offset + length],
+            )
+
+        offset += length
+
+    return audio.mean(axis=1) if mono else audio
+
+
+def frame_power_region(
+    input_file: Union[str, Path],
+    first: int,
+    last: int,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> np.ndarray:
+    """Frames [first, last) of the centered frame power of a file, downmixed to mono
+
+    Only the samples under those frames are read. As long as first is a multiple of
+    BLOCK_FRAMES, the running sums are grouped like frame_power on the whole file,
+    so regions computed by different workers concatenate to the exact same result.
+
+    Args:
+        input_file: input audio file, must be readable by soundfile
+        first: first frame
+        last: end frame, excluded
+        frame_length: frame length
+        hop_length: hop length
+
+    Returns:
+        frame powers, in float64
+    """
+
+    # Samples under the frames, in the coordinates of the unpadded file
+    start = first * hop_length - frame_length // 2
+    end = (last - 1) * hop_length - frame_length // 2 + frame_length
+    samples = np.zeros(end - start, dtype=np.float32)
+
+    with sf.SoundFile(str(input_file)) as f:
+        begin, stop = max(start, 0), min(end, f.frames)
+
+        if stop > begin:
+            samples[begin - start : stop - start] = read_pieces(f, [(begin, stop)])
+
+    return frame_power(samples, frame_length, hop_length, center=False)
+
+
+def frame_power_parallel(
+    executor: Executor,
+    input_file: Union[str, Path],
+    n_samples: int,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+    n_regions: int = 1,
+) -> np.ndarray:
+    """Centered frame power of a file, downmixed to mono, computed by region in a pool
+
+    The regions overlap by frame_length - hop_length samples, and the result is
+    identical to frame_power on the whole mono file.
+
+    Args:
+        executor: pool computing the regions
+        input_file: input audio file, must be readable by soundfile
+        n_samples: number of samples of the file
+        frame_length: frame length
+        hop_length: hop length
+        n_regions: number of regions to split the file into, at most
+
+    Returns:
+        frame powers, in float64
+    """
+
+    pad = frame_length // 2
+    n_frames = max(0, 1 + (n_samples + 2 * pad - frame_length) // hop_length)
+    region = math.ceil(n_frames / max(n_regions, 1) / BLOCK_FRAMES) * BLOCK_FRAMES
+
+    futures = [
+        executor.submit(
+            frame_power_region,
+            str(input_file),
+            first,
+            min(first + region, n_frames),
+            frame_length,
+            hop_length,
+        )
+        for first in range(0, n_frames, max(region, BLOCK_FRAMES))
+    ]
+
+    return np.concatenate([np.zeros(0)] + [future.result() for future in futures])
+
+
+def write_slices(
+    input_file: Union[str, Path],
+    slices: list[tuple[str, list[tuple[Optional[int], int]]]],
+    rate: int,
+) -> None:
+    """Read slices described by their pieces from a file and save them
+
+    Args:
+        input_file: input audio file, must be readable by soundfile
+        slices: output file and pieces of each slice
+        rate: sample rate
+    """
+
+    with sf.SoundFile(str(input_file)) as f:
+        for output_file, pieces in slices:
+            sf.write(output_file, read_pieces(f, pieces), rate)
+
+
+def write_slices_parallel(
+    executor: Executor,
+    input_file: Union[str, Path],
+    slices: list[tuple[str, list[tuple[Optional[int], int]]]],
+    rate: int,
+    n_tasks: int = 1,
+) -> None:
+    """Save slices with write_slices, spread over a pool
+
+    Every task gets consecutive slices of about the same total duration, so the
+    split points between tasks always fall between slices, in silences.
+
+    Args:
+        executor: pool writing the slices
+        input_file: input audio file, must be readable by soundfile
+        slices: output file and pieces of each slice
+        rate: sample rate
+        n_tasks: number of tasks, at most
+    """
+
+    lengths = [
+        sum(end - start if start is not None else end for start, end in pieces)
+        for _, pieces in slices
+    ]
+    bounds = np.cumsum(lengths)
+    splits = np.searchsorted(
+        bounds, np.linspace(0, bounds[-1] if len(bounds) else 0, n_tasks + 1)[1:-1]
+    )
+
+    futures = [
+        executor.submit(write_slices, str(input_file), slices[begin:end], rate)
+        for begin, end in zip([0, *splits], [*splits, len(slices)])
+        if end > begin
+    ]
+
+    for future in futures:
+        future.result()
+
+
+def slice_audio_stream(
+    input_file: Union[str, Path],
+    min_duration: float = 6.0,
+    max_duration: float = 30.0,
+    pad_silence: float = 0.4,
+    top_db: int = 60,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> Iterable[np.ndarray]:
+    """Slice audio by silence without loading the whole file
+
+    Produces the same slices as slice_audio on the mono file, but detects the
+    non-silent intervals block by block and reads each slice back when it is
+    complete, so memory does not grow with the length of the file.
+
+    Args:
+        input_file: input audio file, must be readable by soundfile
+        min_duration: minimum duration of each slice
+        max_duration: maximum duration of each slice
+        pad_silence: pad silence between each non-silent slice
+        top_db: top_db of librosa.effects.split
+        frame_length: frame_length of librosa.effects.split
+        hop_length: hop_length of librosa.effects.split
+
+    Returns:
+        Iterable of sliced audio
+    """
+
+    intervals = _nonsilent_intervals_stream(
+        input_file, top_db=top_db, frame_length=frame_length, hop_length=hop_length
+    )
+
+    with sf.SoundFile(str(input_file)) as f:
+        for pieces in plan_slices(
+            intervals, f.frames, f.samplerate, min_duration, max_duration, pad_silence
+        ):
+            yield read_pieces(f, pieces)
 
 
 def slice_audio_file(
@@ -101,7 +611,10 @@ def slice_audio_file(
     top_db: int = 60,
     frame_length: int = 2048,
     hop_length: int = 512,
-) -> None:
+    streaming: bool = False,
+    index_only: bool = False,
+    async_write: bool = False,
+) -> Optional[list[dict]]:
     """
     Slice audio by silence and save to output folder
 
@@ -114,22 +627,124 @@ def slice_audio_file(
         top_db: top_db of librosa.effects.split
         frame_length: frame_length of librosa.effects.split
         hop_length: hop_length of librosa.effects.split
+        streaming: decode block by block instead of loading the whole file
+        index_only: don't write any audio, return the manifest records instead
+        async_write: write from the background writer of the process, while the
+            next slices are assembled, see write_slices_to
+
+    Returns:
+        manifest records of the slices if index_only, else None
     """
 
     output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
+    plan_kwargs = dict(
+        min_duration=min_duration, max_duration=max_duration, pad_silence=pad_silence
+    )
+    split_kwargs = dict(top_db=top_db, frame_length=frame_length, hop_length=hop_length)
+
+    try:
+        info = sf.info(str(input_file)) if streaming else None
+    except RuntimeError:
+        # Not readable by soundfile, fall back to librosa
+        info = None
 
-    audio, rate = librosa.load(str(input_file), sr=None, mono=True)
-    for idx, sliced in enumerate(
-        slice_audio(
-            audio,
+    if info is not None:
+        rate = info.samplerate
+        plans = plan_slices(
+            _nonsilent_intervals_stream(input_file, **split_kwargs),
+            info.frames,
             rate,
-            min_duration=min_duration,
-            max_duration=max_duration,
-            pad_silence=pad_silence,
-            top_db=top_db,
-            frame_length=frame_length,
-            hop_length=hop_length,
+            **plan_kwargs,
         )
-    ):
-        sf.write(str(output_dir / f"{idx:04d}.wav"), sliced, rate)
+    else:
+        audio, rate = librosa.load(str(input_file), sr=None, mono=True)
+        plans = plan_slices(
+            _nonsilent_intervals(audio, **split_kwargs), len(audio), rate, **plan_kwargs
+        )
+
+    if index_only:
+        return slice_records(input_file, rate, plans)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with write_slices_to(async_write) as write:
+        if info is not None:
+            with sf.SoundFile(str(input_file)) as f:
+                for idx, pieces in enumerate(plans):
+                    write(
+                        str(output_dir / f"{idx:04d}.wav"), read_pieces(f, pieces), rate
+                    )
+        else:
+            for idx, pieces in enumerate(plans):
+                write(
+                    str(output_dir / f"{idx:04d}.wav"), take_pieces(audio, pieces), rate
+                )
+
+
+def slice_audio_file_parallel(
+    executor: Executor,
+    input_file: Union[str, Path],
+    output_dir: Union[str, Path],
+    min_duration: float = 6.0,
+    max_duration: float = 30.0,
+    pad_silence: float = 0.4,
+    top_db: int = 60,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+    index_only: bool = False,
+    n_tasks: int = 1,
+) -> Optional[list[dict]]:
+    """
+    Same as slice_audio_file, but one file is processed by the whole pool
+
+    The frame power is computed by region in the pool, the slices are planned
+    here, and their writing is spread over the pool again. The slices are
+    identical to those of slice_audio_file.
+
+    Args:
+        executor: pool processing the file
+        input_file: input audio file, must be readable by soundfile
+        output_dir: output folder
+        min_duration: minimum duration of each slice
+        max_duration: maximum duration of each slice
+        pad_silence: pad silence between each non-silent slice
+        top_db: top_db of librosa.effects.split
+        frame_length: frame_length of librosa.effects.split
+        hop_length: hop_length of librosa.effects.split
+        index_only: don't write any audio, return the manifest records instead
+        n_tasks: number of tasks of each stage
+
+    Returns:
+        manifest records of the slices if index_only, else None
+    """
+
+    output_dir = Path(output_dir)
+    info = sf.info(str(input_file))
+    rate = info.samplerate
+
+    power = frame_power_parallel(
+        executor, input_file, info.frames, frame_length, hop_length, n_tasks
+    )
+    intervals = _nonsilent_intervals_from_power(
+        [power], _power_threshold(power.max(initial=0), top_db), hop_length, info.frames
+    )
+    plans = list(
+        plan_slices(
+            intervals, info.frames, rate, min_duration, max_duration, pad_silence
+        )
+    )
+
+    if index_only:
+        return slice_records(input_file, rate, plans)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    write_slices_parallel(
+        executor,
+        input_file,
+        [
+            (str(output_dir / f"{idx:04d}.wav"), pieces)
+            for idx, pieces in enumerate(plans)
+        ],
+        rate,
+        n_tasks,
+    )
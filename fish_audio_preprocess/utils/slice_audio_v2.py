@@ -1,31 +1,89 @@
 # This file is edited from https://github.com/openvpi/audio-slicer/blob/main/slicer2.py
 
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Iterable, Union
+from typing import Iterable, Optional, Union
 
 import librosa
 import numpy as np
 import soundfile as sf
 
-from fish_audio_preprocess.utils.slice_audio import slice_by_max_duration
-
-
-def merge_short_chunks(chunks, max_duration, rate):
-    merged_chunks = []
+from fish_audio_preprocess.utils.cache import (
+    cache_file,
+    file_fingerprint,
+    load_npz,
+    save_npz,
+)
+from fish_audio_preprocess.utils.energy import frame_rms
+from fish_audio_preprocess.utils.kernels import (
+    flatten_slices,
+    get_backend,
+    sil_tags_kernel,
+    split_by_max_duration_kernel,
+    unflatten_slices,
+)
+from fish_audio_preprocess.utils.manifest import slice_records
+from fish_audio_preprocess.utils.slice_audio import (
+    frame_power_parallel,
+    slice_pieces_by_max_duration,
+    take_pieces,
+    write_slices_parallel,
+)
+from fish_audio_preprocess.utils.writer import write_slices_to
+
+
+def _merge_short_groups(lengths, max_duration, rate):
+    groups = []
     buffer, length = [], 0
 
-    for chunk in chunks:
-        if length + len(chunk) > max_duration * rate and len(buffer) > 0:
-            merged_chunks.append(np.concatenate(buffer))
-            buffer, length = [chunk], 0
+    for idx, chunk_length in enumerate(lengths):
+        if length + chunk_length > max_duration * rate and len(buffer) > 0:
+            groups.append(buffer)
+            buffer, length = [idx], 0
         else:
-            buffer.append(chunk)
-            length += len(chunk)
+            buffer.append(idx)
+            length += chunk_length
 
     if len(buffer) > 0:
-        merged_chunks.append(np.concatenate(buffer))
+        groups.append(buffer)
+
+    return groups
+
+
+def merge_short_chunks(chunks, max_duration, rate):
+    return [
+        (
+            chunks[group[0]]
+            if len(group) == 1
+            else np.concatenate([chunks[idx] for idx in group])
+        )
+        for group in _merge_short_groups(map(len, chunks), max_duration, rate)
+    ]
+
+
+def _merge_short_pieces(slices, max_duration, rate):
+    lengths = [sum(end - start for start, end in pieces) for pieces in slices]
+
+    return [
+        [piece for idx in group for piece in slices[idx]]
+        for group in _merge_short_groups(lengths, max_duration, rate)
+    ]
+
 
-    return merged_chunks
+def _segment_argmin(
+    values: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    """First index of the minimum of values[start:end], for each non-empty range"""
+
+    lengths = ends - starts
+    offsets = np.cumsum(lengths) - lengths
+    segments = np.repeat(np.arange(len(starts)), lengths)
+    index = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+
+    # Sort by range, then value, then position, and take the head of each range
+    order = np.lexsort((index, values[index], segments))
+
+    return index[order[offsets]]
 
 
 class Slicer:
@@ -56,15 +114,141 @@ class Slicer:
         self.min_interval = round(min_interval / self.hop_size)
         self.max_sil_kept = round(sr * max_sil_kept / 1000 / self.hop_size)
 
-    def _apply_slice(self, waveform, begin, end):
-        if len(waveform.shape) > 1:
-            return waveform[
-                :, begin * self.hop_size : min(waveform.shape[1], end * self.hop_size)
-            ]
-        else:
-            return waveform[
-                begin * self.hop_size : min(waveform.shape[0], end * self.hop_size)
-            ]
+    def _get_sil_tags(self, rms_list: np.ndarray) -> list[tuple[int, int]]:
+        """Find the ranges of silent frames to be removed
+
+        Silent runs are found with run-length encoding of the threshold mask, and
+        the leading / middle / trailing rules are evaluated for all runs at once.
+        Only the choice of which runs to cut is sequential, since it depends on
+        the previous cut, and that walk only visits the runs actually cut.
+
+        Args:
+            rms_list: rms of each frame
+
+        Returns:
+            list of (begin, end) frames to be removed
+        """
+
+        if get_backend() == "numba":
+            sil_tags = sil_tags_kernel(
+                rms_list,
+                rms_list.dtype.type(self.threshold),
+                self.min_interval,
+                self.min_length,
+                self.max_sil_kept,
+            )
+
+            return [(begin, end) for begin, end in sil_tags.tolist()]
+
+        total_frames = rms_list.shape[0]
+        k = self.max_sil_kept
+
+        # Run-length encoding of the silent frames
+        edges = np.diff(
+            (rms_list < self.threshold).astype(np.int8), prepend=0, append=0
+        )
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        # A run reaching the last frame is trailing silence, handled separately
+        trailing_start = None
+        if len(ends) > 0 and ends[-1] == total_frames:
+            trailing_start = starts[-1]
+            starts, ends = starts[:-1], ends[:-1]
+
+        # Drop the runs that can never be cut
+        leading = (starts == 0) & (ends > k)
+        keep = leading | (ends - starts >= self.min_interval)
+        starts, ends, leading = starts[keep], ends[keep], leading[keep]
+        lengths = ends - starts
+
+        # Range of silent frames removed by each run, if it is cut
+        tag_begin, tag_end = np.empty_like(starts), np.empty_like(starts)
+
+        short = lengths <= k
+        pos = _segment_argmin(rms_list, starts[short], ends[short] + 1)
+        tag_begin[short], tag_end[short] = pos, pos
+
+        long = ~short
+        pos_l = _segment_argmin(rms_list, starts[long], starts[long] + k + 1)
+        pos_r = _segment_argmin(rms_list, ends[long] - k, ends[long] + 1)
+        tag_begin[long], tag_end[long] = pos_l, pos_r
+
+        # Up to 2k frames, the quietest frame of the overlap can widen the range
+        middle = long & (lengths <= 2 * k) & (starts > 0)
+        pos = _segment_argmin(rms_list, ends[middle] - k, starts[middle] + k + 1)
+        tag_begin[middle] = np.minimum(tag_begin[middle], pos)
+        tag_end[middle] = np.maximum(tag_end[middle], pos)
+
+        # Leading silence is removed from the very first frame
+        tag_begin[starts == 0] = 0
+
+        # A cut resets the clip start to tag_end, the next run that can be cut
+        # is the first one ending at least min_length frames later
+        jump = np.maximum(
+            np.searchsorted(ends, tag_end + self.min_length),
+            np.arange(1, len(ends) + 1),
+        )
+        idx = (
+            0
+            if len(ends) > 0 and leading[0]
+            else np.searchsorted(ends, self.min_length)
+        )
+
+        sil_tags = []
+        while idx < len(ends):
+            sil_tags.append((int(tag_begin[idx]), int(tag_end[idx])))
+            idx = jump[idx]
+
+        # Deal with trailing silence.
+        if (
+            trailing_start is not None
+            and total_frames - trailing_start >= self.min_interval
+        ):
+            silence_end = min(total_frames, trailing_start + k)
+            pos = rms_list[trailing_start : silence_end + 1].argmin() + trailing_start
+            sil_tags.append((int(pos), total_frames + 1))
+
+        return sil_tags
+
+    def get_rms(self, samples: np.ndarray) -> np.ndarray:
+        return frame_rms(samples, self.win_size, self.hop_size)
+
+    def get_ranges(self, rms_list: np.ndarray, n_samples: int) -> list[tuple[int, int]]:
+        """Sample ranges of the chunks kept between the removed silences
+
+        Args:
+            rms_list: rms of each frame, from get_rms
+            n_samples: number of samples of the waveform
+
+        Returns:
+            list of (begin, end) samples
+        """
+
+        if n_samples <= self.min_length:
+            return [(0, n_samples)]
+
+        sil_tags = self._get_sil_tags(rms_list)
+        total_frames = rms_list.shape[0]
+
+        if len(sil_tags) == 0:
+            return [(0, n_samples)]
+
+        ranges = []
+
+        if sil_tags[0][0] > 0:
+            ranges.append((0, sil_tags[0][0]))
+
+        for i in range(len(sil_tags) - 1):
+            ranges.append((sil_tags[i][1], sil_tags[i + 1][0]))
+
+        if sil_tags[-1][1] < total_frames:
+            ranges.append((sil_tags[-1][1], total_frames))
+
+        return [
+            (begin * self.hop_size, min(n_samples, end * self.hop_size))
+            for begin, end in ranges
+        ]
 
     def slice(self, waveform):
         if len(waveform.shape) > 1:
@@ -75,120 +259,79 @@ class Slicer:
         if samples.shape[0] <= self.min_length:
             return [waveform]
 
-        rms_list = librosa.feature.rms(
-            y=samples, frame_length=self.win_size, hop_length=self.hop_size
-        ).squeeze(0)
-        sil_tags = []
-        silence_start = None
-        clip_start = 0
-
-        for i, rms in enumerate(rms_list):
-            # Keep looping while frame is silent.
-            if rms < self.threshold:
-                # Record start of silent frames.
-                if silence_start is None:
-                    silence_start = i
-                continue
-
-            # Keep looping while frame is not silent and silence start has not been recorded.
-            if silence_start is None:
-                continue
-
-            # Clear recorded silence start if interval is not enough or clip is too short
-            is_leading_silence = silence_start == 0 and i > self.max_sil_kept
-            need_slice_middle = (
-                i - silence_start >= self.min_interval
-                and i - clip_start >= self.min_length
-            )
+        return [
+            waveform[..., begin:end]
+            for begin, end in self.get_ranges(self.get_rms(samples), len(samples))
+        ]
 
-            if not is_leading_silence and not need_slice_middle:
-                silence_start = None
-                continue
-
-            # Need slicing. Record the range of silent frames to be removed.
-            if i - silence_start <= self.max_sil_kept:
-                pos = rms_list[silence_start : i + 1].argmin() + silence_start
-
-                if silence_start == 0:
-                    sil_tags.append((0, pos))
-                else:
-                    sil_tags.append((pos, pos))
-
-                clip_start = pos
-            elif i - silence_start <= self.max_sil_kept * 2:
-                pos = rms_list[
-                    i - self.max_sil_kept : silence_start + self.max_sil_kept + 1
-                ].argmin()
-                pos += i - self.max_sil_kept
-                pos_l = (
-                    rms_list[
-                        silence_start : silence_start + self.max_sil_kept + 1
-                    ].argmin()
-                    + silence_start
-                )
-                pos_r = (
-                    rms_list[i - self.max_sil_kept : i + 1].argmin()
-                    + i
-                    - self.max_sil_kept
-                )
-
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                    clip_start = pos_r
-                else:
-                    sil_tags.append((min(pos_l, pos), max(pos_r, pos)))
-                    clip_start = max(pos_r, pos)
-            else:
-                pos_l = (
-                    rms_list[
-                        silence_start : silence_start + self.max_sil_kept + 1
-                    ].argmin()
-                    + silence_start
-                )
-                pos_r = (
-                    rms_list[i - self.max_sil_kept : i + 1].argmin()
-                    + i
-                    - self.max_sil_kept
-                )
-
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                else:
-                    sil_tags.append((pos_l, pos_r))
-
-                clip_start = pos_r
-            silence_start = None
 
-        # Deal with trailing silence.
-        total_frames = rms_list.shape[0]
-        if (
-            silence_start is not None
-            and total_frames - silence_start >= self.min_interval
-        ):
-            silence_end = min(total_frames, silence_start + self.max_sil_kept)
-            pos = rms_list[silence_start : silence_end + 1].argmin() + silence_start
-            sil_tags.append((pos, total_frames + 1))
+def _make_slicer(
+    rate: int,
+    min_duration: float = 5.0,
+    min_silence_duration: float = 0.3,
+    top_db: int = -40,
+    hop_length: int = 10,
+    max_silence_kept: float = 0.5,
+) -> Slicer:
+    return Slicer(
+        sr=rate,
+        threshold=top_db,
+        min_length=min_duration * 1000,
+        min_interval=min_silence_duration * 1000,
+        hop_size=hop_length,
+        max_sil_kept=max_silence_kept * 1000,
+    )
 
-        # Apply and return slices.
-        if len(sil_tags) == 0:
-            return [waveform]
-        else:
-            chunks = []
 
-            if sil_tags[0][0] > 0:
-                chunks.append(self._apply_slice(waveform, 0, sil_tags[0][0]))
+def plan_slices_v2(
+    slicer: Slicer,
+    rms_list: Optional[np.ndarray],
+    n_samples: int,
+    rate: int,
+    min_duration: float = 5.0,
+    max_duration: float = 30.0,
+    merge_short: bool = False,
+) -> list[list[tuple[int, int]]]:
+    """Plan the slices of slice_audio_v2 without touching the audio
 
-            for i in range(len(sil_tags) - 1):
-                chunks.append(
-                    self._apply_slice(waveform, sil_tags[i][1], sil_tags[i + 1][0])
-                )
+    Args:
+        slicer: the slicer
+        rms_list: rms of each frame, from slicer.get_rms, unused if the audio is
+            shorter than min_duration
+        n_samples: number of samples of the audio
+        rate: sample rate
+        min_duration: minimum duration of each slice
+        max_duration: maximum duration of each slice
+        merge_short: merge short slices automatically
 
-            if sil_tags[-1][1] < total_frames:
-                chunks.append(
-                    self._apply_slice(waveform, sil_tags[-1][1], total_frames)
-                )
+    Returns:
+        list of slices, each as the (start, end) sample ranges to concatenate
+    """
+
+    if n_samples / rate < min_duration:
+        slices = list(
+            slice_pieces_by_max_duration([(0, n_samples)], max_duration, rate)
+        )
+
+        return (
+            _merge_short_pieces(slices, max_duration, rate) if merge_short else slices
+        )
+
+    slices = [[chunk] for chunk in slicer.get_ranges(rms_list, n_samples)]
+
+    if merge_short:
+        slices = _merge_short_pieces(slices, max_duration, rate)
+
+    if get_backend() == "numba":
+        return unflatten_slices(
+            *split_by_max_duration_kernel(*flatten_slices(slices), max_duration * rate)
+        )
 
-            return chunks
+    return [
+        pieces
+        for chunk in slices
+        for pieces in slice_pieces_by_max_duration(chunk, max_duration, rate)
+    ]
 
 
 def slice_audio_v2(
@@ -219,31 +362,27 @@ def slice_audio_v2(
         Iterable of sliced audio
     """
 
-    if len(audio) / rate < min_duration:
-        sliced_by_max_duration_chunk = slice_by_max_duration(audio, max_duration, rate)
-        yield from (
-            merge_short_chunks(sliced_by_max_duration_chunk, max_duration, rate)
-            if merge_short
-            else sliced_by_max_duration_chunk
-        )
-        return
-
-    slicer = Slicer(
-        sr=rate,
-        threshold=top_db,
-        min_length=min_duration * 1000,
-        min_interval=min_silence_duration * 1000,
-        hop_size=hop_length,
-        max_sil_kept=max_silence_kept * 1000,
+    slicer = _make_slicer(
+        rate,
+        min_duration=min_duration,
+        min_silence_duration=min_silence_duration,
+        top_db=top_db,
+        hop_length=hop_length,
+        max_silence_kept=max_silence_kept,
     )
-
-    sliced_audio = slicer.slice(audio)
-    if merge_short:
-        sliced_audio = merge_short_chunks(sliced_audio, max_duration, rate)
-
-    for chunk in sliced_audio:
-        sliced_by_max_duration_chunk = slice_by_max_duration(chunk, max_duration, rate)
-        yield from sliced_by_max_duration_chunk
+    samples = audio.mean(axis=1) if audio.ndim > 1 else audio
+    rms_list = None if len(audio) / rate < min_duration else slicer.get_rms(samples)
+
+    for pieces in plan_slices_v2(
+        slicer,
+        rms_list,
+        len(audio),
+        rate,
+        min_duration=min_duration,
+        max_duration=max_duration,
+        merge_short=merge_short,
+    ):
+        yield take_pieces(audio, pieces)
 
 
 def slice_audio_file_v2(
@@ -257,7 +396,9 @@ def slice_audio_file_v2(
     max_silence_kept: float = 0.5,
     flat_layout: bool = False,
     merge_short: bool = False,
-) -> None:
+    index_only: bool = False,
+    async_write: bool = False,
+) -> Optional[list[dict]]:
     """
     Slice audio by silence and save to output folder
 
@@ -272,25 +413,242 @@ def slice_audio_file_v2(
         max_silence_kept: maximum duration of silence to be kept
         flat_layout: use flat directory structure
         merge_short: merge short slices automatically
+        index_only: don't write any audio, return the manifest records instead
+        async_write: write from the background writer of the process, while the
+            next slices are assembled, see write_slices_to
+
+    Returns:
+        manifest records of the slices if index_only, else None
     """
 
     output_dir = Path(output_dir)
 
     audio, rate = librosa.load(str(input_file), sr=None, mono=True)
-    for idx, sliced in enumerate(
-        slice_audio_v2(
-            audio,
+    slicer = _make_slicer(
+        rate,
+        min_duration=min_duration,
+        min_silence_duration=min_silence_duration,
+        top_db=top_db,
+        hop_length=hop_length,
+        max_silence_kept=max_silence_kept,
+    )
+    slices = plan_slices_v2(
+        slicer,
+        None if len(audio) / rate < min_duration else slicer.get_rms(audio),
+        len(audio),
+        rate,
+        min_duration=min_duration,
+        max_duration=max_duration,
+        merge_short=merge_short,
+    )
+
+    if index_only:
+        return slice_records(input_file, rate, slices)
+
+    with write_slices_to(async_write) as write:
+        for idx, pieces in enumerate(slices):
+            sliced = take_pieces(audio, pieces)
+
+            if flat_layout:
+                write(str(output_dir) + f"_{idx:04d}.wav", sliced, rate)
+            else:
+                write(str(output_dir / f"{idx:04d}.wav"), sliced, rate)
+
+
+def slice_audio_file_v2_parallel(
+    executor: Executor,
+    input_file: Union[str, Path],
+    output_dir: Union[str, Path],
+    min_duration: float = 5.0,
+    max_duration: float = 30.0,
+    min_silence_duration: float = 0.3,
+    top_db: int = -40,
+    hop_length: int = 10,
+    max_silence_kept: float = 0.5,
+    flat_layout: bool = False,
+    merge_short: bool = False,
+    index_only: bool = False,
+    n_tasks: int = 1,
+) -> Optional[list[dict]]:
+    """
+    Same as slice_audio_file_v2, but one file is processed by the whole pool
+
+    The rms is computed by region in the pool, the silences are found here on the
+    stitched rms, and the writing of the slices is spread over the pool again.
+    The slices are identical to those of slice_audio_file_v2.
+
+    Args:
+        executor: pool processing the file
+        input_file: input audio file, must be readable by soundfile
+        output_dir: output folder
+        min_duration: minimum duration of each slice
+        max_duration: maximum duration of each slice
+        min_silence_duration: minimum duration of silence
+        top_db: threshold to detect silence
+        hop_length: hop length to detect silence
+        max_silence_kept: maximum duration of silence to be kept
+        flat_layout: use flat directory structure
+        merge_short: merge short slices automatically
+        index_only: don't write any audio, return the manifest records instead
+        n_tasks: number of tasks of each stage
+
+    Returns:
+        manifest records of the slices if index_only, else None
+    """
+
+    output_dir = Path(output_dir)
+    info = sf.info(str(input_file))
+    rate, n_samples = info.samplerate, info.frames
+
+    slicer = _make_slicer(
+        rate,
+        min_duration=min_duration,
+        min_silence_duration=min_silence_duration,
+        top_db=top_db,
+        hop_length=hop_length,
+        max_silence_kept=max_silence_kept,
+    )
+    rms_list = None
+
+    if n_samples / rate >= min_duration:
+        rms_list = np.sqrt(
+            frame_power_parallel(
+                executor,
+                input_file,
+                n_samples,
+                slicer.win_size,
+                slicer.hop_size,
+                n_tasks,
+            )
+        )
+
+    slices = plan_slices_v2(
+        slicer,
+        rms_list,
+        n_samples,
+        rate,
+        min_duration=min_duration,
+        max_duration=max_duration,
+        merge_short=merge_short,
+    )
+
+    if index_only:
+        return slice_records(input_file, rate, slices)
+
+    write_slices_parallel(
+        executor,
+        input_file,
+        [
+            (
+                (
+                    str(output_dir) + f"_{idx:04d}.wav"
+                    if flat_layout
+                    else str(output_dir / f"{idx:04d}.wav")
+                ),
+                pieces,
+            )
+            for idx, pieces in enumerate(slices)
+        ],
+        rate,
+        n_tasks,
+    )
+
+
+def sweep_file_v2(
+    input_file: Union[str, Path],
+    param_sets: list[dict],
+    max_duration: float = 30.0,
+    hop_length: int = 10,
+    merge_short: bool = False,
+    cache_dir: Optional[Union[str, Path]] = None,
+) -> list[np.ndarray]:
+    """
+    Evaluate several slicer settings on a file without writing any audio
+
+    The file is decoded at most once, and the rms of each (window, hop) pair is
+    cached on disk, so later sweeps on the same file don't decode it at all.
+
+    Args:
+        input_file: input audio file
+        param_sets: keyword arguments of each setting, among min_duration,
+            min_silence_duration, top_db and max_silence_kept
+        max_duration: maximum duration of each slice
+        hop_length: hop length to detect silence
+        merge_short: merge short slices automatically
+        cache_dir: cache directory, no cache if None
+
+    Returns:
+        durations of the slices, for each setting
+    """
+
+    fingerprint = file_fingerprint(input_file)
+    audio = None
+
+    def decode():
+        audio, rate = librosa.load(str(input_file), sr=None, mono=True)
+
+        if cache_dir is not None:
+            save_npz(
+                cache_file(cache_dir, "meta", fingerprint),
+                rate=rate,
+                n_samples=len(audio),
+            )
+
+        return audio, rate
+
+    meta = (
+        None
+        if cache_dir is None
+        else load_npz(cache_file(cache_dir, "meta", fingerprint))
+    )
+
+    if meta is None:
+        audio, rate = decode()
+        n_samples = len(audio)
+    else:
+        rate, n_samples = int(meta["rate"]), int(meta["n_samples"])
+
+    rms_lists = {}
+    results = []
+
+    for params in param_sets:
+        slicer = _make_slicer(rate, hop_length=hop_length, **params)
+        min_duration = params.get("min_duration", 5.0)
+        key = (slicer.win_size, slicer.hop_size)
+
+        if n_samples / rate >= min_duration and key not in rms_lists:
+            path = (
+                None
+                if cache_dir is None
+                else cache_file(cache_dir, "rms", fingerprint, *key)
+            )
+            cached = None if path is None else load_npz(path)
+
+            if cached is not None:
+                rms_lists[key] = cached["rms"]
+            else:
+                if audio is None:
+                    audio, _ = decode()
+
+                # Half the size of the float64 rms, in memory and on disk, the
+                # rounding only matters for frames within 1e-7 of the threshold
+                rms_lists[key] = slicer.get_rms(audio).astype(np.float32)
+
+                if path is not None:
+                    save_npz(path, rms=rms_lists[key])
+
+        slices = plan_slices_v2(
+            slicer,
+            rms_lists.get(key),
+            n_samples,
             rate,
             min_duration=min_duration,
             max_duration=max_duration,
-            min_silence_duration=min_silence_duration,
-            top_db=top_db,
-            hop_length=hop_length,
-            max_silence_kept=max_silence_kept,
             merge_short=merge_short,
         )
-    ):
-        if flat_layout:
-            sf.write(str(output_dir) + f"_{idx:04d}.wav", sliced, rate)
-        else:
-            sf.write(str(output_dir / f"{idx:04d}.wav"), sliced, rate)
+        results.append(
+            np.array([sum(end - start for start, end in pieces) for pieces in slices])
+            / rate
+        )
+
+    return results
@@ -1,5 +1,6 @@
+import os
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Union
 
 from loguru import logger
 from tqdm import tqdm
@@ -13,50 +14,112 @@ PROMPT = {
 ASRModelType = Literal["funasr", "whisper"]
 
 
-def batch_transcribe(
-    files: list[Path],
-    model_size: str,
-    model_type: ASRModelType,
-    lang: str,
-    pos: int,
-):
-    results = {}
+def lab_path(file: Union[str, Path]) -> Path:
+    """Path of the transcript of an audio file, next to it with a .lab suffix"""
+
+    return Path(file).with_suffix(".lab")
+
+
+def save_transcript(path: Union[str, Path], text: str):
+    """Atomically write a transcript, so that a crash never leaves a partial file
+
+    Args:
+        path: path to the .lab file
+        text: the transcript
+    """
+
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+
+    os.replace(tmp, path)
+
+
+# Model of the current worker process, see init_worker
+_model = None
+_model_type = None
+_lang = None
+
+
+def init_worker(model_size: str, model_type: ASRModelType, lang: str):
+    """Load the model of the current process, once for all the files it transcribes
+
+    Args:
+        model_size: model name
+        model_type: funasr or whisper
+        lang: language of the audio
+    """
+
+    global _model, _model_type, _lang
+
+    logger.info(f"Loading {model_size} model for {lang} transcription")
+
     if model_type == "whisper":
         import whisper
 
-        logger.info(f"Loading {model_size} model for {lang} transcription")
-        model = whisper.load_model(model_size)
-        for file in tqdm(files, position=pos):
-            if lang in PROMPT:
-                result = model.transcribe(
-                    file, language=lang, initial_prompt=PROMPT[lang]
-                )
-            else:
-                result = model.transcribe(file, language=lang)
-            results[str(file)] = result["text"]
+        _model = whisper.load_model(model_size)
     elif model_type == "funasr":
         from funasr import AutoModel
 
-        logger.info(f"Loading {model_size} model for {lang} transcription")
-        model = AutoModel(
+        _model = AutoModel(
             model=model_size,
             vad_model="fsmn-vad",
             punc_model="ct-punc",
             log_level="ERROR",
             disable_pbar=True,
         )
-        for file in tqdm(files, position=pos):
-            if lang in PROMPT:
-                result = model.generate(
-                    input=file, batch_size_s=300, hotword=PROMPT[lang]
-                )
-            else:
-                result = model.generate(input=file, batch_size_s=300)
-            # print(result)
-            if isinstance(result, list):
-                results[str(file)] = "".join([item["text"] for item in result])
-            else:
-                results[str(file)] = result["text"]
     else:
         raise ValueError(f"Unsupported model type: {model_type}")
-    return results
+
+    _model_type, _lang = model_type, lang
+
+
+def transcribe_file(file: Union[str, Path]) -> str:
+    """Transcribe a file with the model of the current process and save its .lab
+
+    Args:
+        file: audio file
+
+    Returns:
+        the transcript
+    """
+
+    if _model_type == "whisper":
+        if _lang in PROMPT:
+            result = _model.transcribe(
+                str(file), language=_lang, initial_prompt=PROMPT[_lang]
+            )
+        else:
+            result = _model.transcribe(str(file), language=_lang)
+
+        text = result["text"]
+    else:
+        if _lang in PROMPT:
+            result = _model.generate(
+                input=str(file), batch_size_s=300, hotword=PROMPT[_lang]
+            )
+        else:
+            result = _model.generate(input=str(file), batch_size_s=300)
+
+        if isinstance(result, list):
+            text = "".join([item["text"] for item in result])
+        else:
+            text = result["text"]
+
+    save_transcript(lab_path(file), text)
+
+    return text
+
+
+def batch_transcribe(
+    files: list[Path],
+    model_size: str,
+    model_type: ASRModelType,
+    lang: str,
+    pos: int,
+):
+    init_worker(model_size, model_type, lang)
+
+    return {str(file): transcribe_file(file) for file in tqdm(files, position=pos)}
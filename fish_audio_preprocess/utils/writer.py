@@ -0,0 +1,226 @@
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Queue
+from threading import Event, Semaphore, Thread
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+import numpy as np
+
+
+class BackgroundWriter:
+    """Write audio files from a background thread
+
+    sf.write releases the GIL while encoding, so the caller can go on decoding and
+    detecting silences while the previous slices are written. The queue is bounded,
+    which bounds the memory held by pending slices.
+
+    Any other writing function can be queued with submit.
+
+    Args:
+        max_pending: maximum number of slices waiting to be written
+    """
+
+    def __init__(self, max_pending: int = 16):
+        self.queue = Queue(max_pending)
+        self.error = None
+        # Seconds spent writing
+        self.busy = 0.0
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                self.queue.task_done()
+                break
+
+            fn, args = item
+            start = time.perf_counter()
+
+            try:
+                fn(*args)
+            except Exception as e:
+                if self.error is None:
+                    self.error = RuntimeError(f"Failed to write {args[0]}: {e}")
+            finally:
+                self.busy += time.perf_counter() - start
+                self.queue.task_done()
+
+    def check(self):
+        """Raise the first error of the previous writes, if any"""
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn: Callable, *args):
+        """Queue a call writing a file, whose path is its first argument"""
+
+        self.check()
+        self.queue.put((fn, args))
+
+    def write(self, path: Union[str, Path], audio: np.ndarray, rate: int):
+        """Queue an audio file to be written, same arguments as sf.write"""
+
+        import soundfile as sf
+
+        self.submit(sf.write, str(path), audio, rate)
+
+    def flush(self):
+        """Wait until every queued file is written"""
+
+        self.queue.join()
+        self.check()
+
+    def drain(self):
+        """Wait until every queued file is written, dropping their errors"""
+
+        self.queue.join()
+        self.error = None
+
+    def close(self):
+        """Flush and stop the thread"""
+
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+_writer: Optional[BackgroundWriter] = None
+_writer_pid: Optional[int] = None
+
+
+def get_writer() -> BackgroundWriter:
+    """Background writer of the current process, flushed when the process exits
+
+    In a worker pool, every worker gets its own writer thread. Tasks should flush
+    it before returning, see write_slices_to, so that failed writes are raised by
+    the task of their file, closing it on exit is only a safety net.
+
+    Returns:
+        the writer
+    """
+
+    global _writer, _writer_pid
+
+    # A forked child inherits the object, but not the thread
+    if _writer is None or _writer_pid != os.getpid():
+        from multiprocessing.util import Finalize
+
+        _writer, _writer_pid = BackgroundWriter(), os.getpid()
+        Finalize(_writer, _writer.close, exitpriority=10)
+
+    return _writer
+
+
+@contextmanager
+def write_slices_to(async_write: bool) -> Iterator[Callable]:
+    """Writing function for the slices of one file, same arguments as sf.write
+
+    With async_write, the slices are written by the background writer of the
+    process, and all of them are written, or their first error raised, when the
+    block exits. If the block fails, the pending slices are dropped silently, so
+    their errors aren't blamed on the next file.
+
+    Args:
+        async_write: write from the background writer
+
+    Returns:
+        context manager giving the writing function
+    """
+
+    if not async_write:
+        import soundfile as sf
+
+        yield sf.write
+        return
+
+    writer = get_writer()
+
+    try:
+        yield writer.write
+    except BaseException:
+        writer.drain()
+        raise
+
+    writer.flush()
+
+
+_DONE = object()
+
+
+def prefetch(
+    fn: Callable, items: Iterable, size: int = 2
+) -> Iterator[tuple[object, object, float]]:
+    """Apply fn to items in a background thread, at most size items ahead
+
+    Typically decodes the next inputs while the caller processes the current one.
+    An item is only taken from items once a slot is free, so when items is shared
+    with other consumers, e.g. a queue, this one never holds more than size
+    items besides the one being processed.
+
+    Args:
+        fn: function applied to each item
+        items: the items
+        size: maximum number of items taken ahead of the caller, 0 to call fn inline
+
+    Returns:
+        generator of (item, fn(item), seconds spent in fn)
+    """
+
+    if size <= 0:
+        for item in items:
+            start = time.perf_counter()
+            result = fn(item)
+            yield item, result, time.perf_counter() - start
+
+        return
+
+    queue = Queue()
+    slots = Semaphore(size)
+    stop = Event()
+
+    def run():
+        iterator = iter(items)
+
+        try:
+            while True:
+                slots.acquire()
+
+                if stop.is_set():
+                    return
+
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+
+                start = time.perf_counter()
+                result = fn(item)
+                queue.put((item, result, time.perf_counter() - start))
+        except BaseException as e:
+            queue.put(e)
+            return
+
+        queue.put(_DONE)
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        while (entry := queue.get()) is not _DONE:
+            if isinstance(entry, BaseException):
+                raise entry
+
+            # The next item is taken while the caller processes this one
+            slots.release()
+            yield entry
+    finally:
+        # Unblock the thread if the caller stopped early
+        stop.set()
+        slots.release()
+        thread.join()
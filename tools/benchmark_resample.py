@@ -0,0 +1,96 @@
+"""Benchmark the resampling backends of `fap resample`.
+
+The input is a sum of sine tones, so the reference can be synthesized exactly at
+the target rate and the SNR only measures the resampler error. Tones above the
+target Nyquist frequency are resampled separately, everything left of them is
+aliasing, reported as the stopband rejection.
+"""
+
+import time
+
+import click
+import numpy as np
+from loguru import logger
+
+from fish_audio_preprocess.utils.resample import RESAMPLERS, resample_audio
+
+
+def synthesize(rate: int, duration: float, freqs: np.ndarray, phases: np.ndarray):
+    t = np.arange(int(rate * duration)) / rate
+    audio = np.sin(2 * np.pi * freqs[:, None] * t[None] + phases[:, None]).sum(0)
+
+    return (audio / len(freqs)).astype(np.float32)
+
+
+def rejection(audio: np.ndarray, output: np.ndarray) -> float:
+    return 10 * np.log10(np.mean(audio**2) / max(np.mean(output**2), 1e-20))
+
+
+def snr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    length = min(len(reference), len(estimate))
+    reference, estimate = reference[:length], estimate[:length]
+    noise = np.sum((reference - estimate) ** 2)
+
+    return 10 * np.log10(np.sum(reference**2) / max(noise, 1e-20))
+
+
+@click.command()
+@click.option("--orig-sr", "-i", multiple=True, type=int, default=[48000, 44100])
+@click.option("--target-sr", "-o", multiple=True, type=int, default=[16000, 24000])
+@click.option("--duration", default=60.0, show_default=True, type=float)
+@click.option("--repeat", default=3, show_default=True, type=int)
+@click.option("--resampler", "-r", multiple=True, type=click.Choice(RESAMPLERS))
+def benchmark(
+    orig_sr: list[int],
+    target_sr: list[int],
+    duration: float,
+    repeat: int,
+    resampler: list[str],
+):
+    """Report speed (x realtime), SNR and stopband rejection (dB) of every resampler."""
+
+    resamplers = resampler or RESAMPLERS
+    rng = np.random.default_rng(0)
+
+    for src in orig_sr:
+        for dst in target_sr:
+            # Keep every tone inside the passband of both rates
+            freqs = rng.uniform(50, 0.8 * min(src, dst) / 2, size=32)
+            phases = rng.uniform(0, 2 * np.pi, size=32)
+            audio = synthesize(src, duration, freqs, phases)
+            reference = synthesize(dst, duration, freqs, phases)
+            stopband = None
+
+            if dst < src:
+                # Clear of the transition band of every resampler
+                freqs = rng.uniform(1.1 * dst / 2, 0.95 * src / 2, size=32)
+                stopband = synthesize(src, duration, freqs, phases)
+
+            # Ignore the filter edge effects
+            edge = dst // 10
+
+            for name in resamplers:
+                # The first call also warms up the cached kernels
+                output = resample_audio(audio, src, dst, name)
+
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    resample_audio(audio, src, dst, name)
+                elapsed = (time.perf_counter() - start) / repeat
+
+                aliasing = "n/a"
+
+                if stopband is not None:
+                    aliased = resample_audio(stopband, src, dst, name)
+                    aliasing = f"{rejection(stopband, aliased[edge:-edge]):6.1f} dB"
+
+                logger.info(
+                    f"{src:>6} -> {dst:>6} Hz {name:>10}: "
+                    f"{duration / elapsed:8.1f}x realtime, "
+                    f"SNR {snr(reference[edge:-edge], output[edge:-edge]):6.1f} dB, "
+                    f"stopband rejection {aliasing}"
+                )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,204 @@
+"""Benchmark `fap separate` settings on synthetic clips."""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import soundfile as sf
+from loguru import logger
+
+from fish_audio_preprocess.cli.separate_audio import separate
+
+
+def synthesize_clips(
+    directory: Path, clips: int, duration: float, rate: int = 44100, seed: int = 0
+) -> float:
+    """Write stereo clips of a tone over noise, returns their total duration"""
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * rate)) / rate
+
+    for idx in range(clips):
+        tone = 0.3 * np.sin(2 * np.pi * rng.uniform(100, 1000) * t)
+        noise = 0.05 * rng.standard_normal((len(t), 2))
+        sf.write(directory / f"{idx:04d}.wav", tone[:, None] + noise, rate)
+
+    return clips * duration
+
+
+def synthesize_mix(duration: float, rate: int = 44100, seed: int = 0) -> np.ndarray:
+    """A stereo mix of a sung melody, a bass line, drums and chords, (2, samples)"""
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * rate)) / rate
+    beat = (t * 2) % 1
+
+    # Melody of a note per beat with vibrato and a few harmonics
+    notes = 220 * 2 ** (rng.integers(0, 12, int(duration * 2) + 1) / 12)
+    phase = 2 * np.pi * np.cumsum(notes[(t * 2).astype(int)] / rate)
+    phase += 0.3 * np.sin(2 * np.pi * 5 * t)
+    vocals = sum(np.sin(k * phase) / k for k in range(1, 6)) * np.exp(-beat)
+    bass = np.sin(2 * np.pi * 55 * 2 ** ((t // 2 % 4) / 12) * t)
+    drums = rng.standard_normal(len(t)) * np.exp(-30 * beat)
+    other = sum(np.sin(2 * np.pi * f * t) for f in (261.6, 329.6, 392.0)) / 3
+
+    mono = 0.2 * vocals + 0.2 * bass + 0.15 * drums + 0.1 * other
+    pan = 0.1 * rng.standard_normal((2, 1))
+
+    return ((1 + pan) * mono).astype(np.float32)
+
+
+def sdr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    """Signal to distortion ratio of an estimate in dB"""
+
+    error = np.sum((reference - estimate) ** 2)
+
+    return 10 * np.log10(np.sum(reference**2) / max(error, 1e-20))
+
+
+def run_separate(input_dir: Path, output_dir: Path, *options: str) -> float:
+    """Wall time of one `fap separate` run"""
+
+    start = time.perf_counter()
+    separate.main(
+        [str(input_dir), str(output_dir), "--overwrite", *options],
+        standalone_mode=False,
+    )
+
+    return time.perf_counter() - start
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--budget", default=os.cpu_count(), show_default=True, type=int)
+@click.option("--workers", "-w", multiple=True, type=int)
+@click.option("--clips", default=32, show_default=True, type=int)
+@click.option("--duration", default=10.0, show_default=True, type=float)
+@click.option("--model", default="htdemucs", show_default=True)
+def cpu_split(budget: int, workers: list[int], clips: int, duration: float, model: str):
+    """Find the best split of a CPU thread budget into workers x threads."""
+
+    # Powers of two up to the budget by default
+    workers = workers or [2**i for i in range(budget.bit_length()) if 2**i <= budget]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir, output_dir = Path(tmp) / "in", Path(tmp) / "out"
+        input_dir.mkdir()
+        total = synthesize_clips(input_dir, clips, duration)
+
+        for count in workers:
+            elapsed = run_separate(
+                input_dir,
+                output_dir,
+                "--model",
+                model,
+                "--num-cpu-workers",
+                str(count),
+                "--num-threads",
+                str(budget),
+            )
+            results[count] = total / elapsed
+
+            logger.info(
+                f"{count:>3} workers x {max(1, budget // count):>3} threads: "
+                f"{elapsed:8.1f} s, {results[count]:6.2f}x realtime"
+            )
+
+    best = max(results, key=results.get)
+    logger.info(
+        f"Best split: --num-cpu-workers {best} --num-threads {budget} "
+        f"({results[best]:.2f}x realtime)"
+    )
+
+
+@cli.command()
+@click.option(
+    "--precision",
+    "-p",
+    multiple=True,
+    type=click.Choice(["fp32", "bf16", "int8"]),
+    help="Precisions to compare, all by default",
+)
+@click.option("--compile/--no-compile", "compile_model", default=False)
+@click.option("--duration", default=30.0, show_default=True, type=float)
+@click.option("--repeat", default=3, show_default=True, type=int)
+@click.option("--threads", default=None, type=int)
+@click.option("--model", default="htdemucs", show_default=True)
+@click.option(
+    "--random-weights/--no-random-weights",
+    default=False,
+    help="Use a seeded, untrained HTDemucs instead of downloading --model",
+)
+def precision(
+    precision: list[str],
+    compile_model: bool,
+    duration: float,
+    repeat: int,
+    threads: int,
+    model: str,
+    random_weights: bool,
+):
+    """Throughput and SDR drift versus fp32 of each precision on CPU."""
+
+    import torch
+
+    from fish_audio_preprocess.utils.separate_audio import (
+        PRECISIONS,
+        init_model,
+        optimize_model,
+        separate_audio,
+    )
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    precision = ["fp32"] + [p for p in precision or PRECISIONS if p != "fp32"]
+    mix = torch.from_numpy(synthesize_mix(duration))
+    reference = None
+
+    for name in precision:
+        if random_weights:
+            from demucs.htdemucs import HTDemucs
+
+            # Same architecture as the pretrained htdemucs, the throughput
+            # matches but the SDR drift only bounds the numerical error
+            torch.manual_seed(0)
+            _model = HTDemucs(["drums", "bass", "other", "vocals"], segment=7.8)
+            _model = optimize_model(_model.eval(), name, compile_model)
+        else:
+            _model = init_model(
+                model, torch.device("cpu"), precision=name, compile_model=compile_model
+            )
+
+        # The first run warms up the caches and the compiled graphs
+        tracks = separate_audio(_model, mix)
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            tracks = separate_audio(_model, mix)
+
+        elapsed = (time.perf_counter() - start) / repeat
+        tracks = {stem: track.numpy() for stem, track in tracks.items()}
+
+        if reference is None:
+            reference = tracks
+
+        drift = " ".join(
+            f"{stem} {sdr(reference[stem], tracks[stem]):6.1f} dB" for stem in tracks
+        )
+        logger.info(
+            f"{name:>4}: {elapsed:6.2f} s, {duration / elapsed:6.2f}x realtime, "
+            f"SDR vs fp32: {drift}"
+        )
+
+
+if __name__ == "__main__":
+    cli()
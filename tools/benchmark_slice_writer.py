@@ -0,0 +1,149 @@
+"""Benchmark slice assembly and the background slice writer.
+
+Reports the time and peak memory of assembling slices with np.concatenate
+versus take_pieces, then the per-worker wall time and peak RSS of slicing a set
+of synthetic files with synchronous and with background writes.
+"""
+
+import multiprocessing as mp
+import resource
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import click
+import numpy as np
+import soundfile as sf
+from loguru import logger
+
+from fish_audio_preprocess.utils.file import split_list
+from fish_audio_preprocess.utils.slice_audio import plan_slices, take_pieces
+
+
+def concatenate_pieces(audio: np.ndarray, pieces) -> np.ndarray:
+    """Slice assembly as done before take_pieces"""
+
+    return np.concatenate(
+        [
+            audio[start:end] if start is not None else np.zeros(end, audio.dtype)
+            for start, end in pieces
+        ]
+    )
+
+
+def synthesize(rng: np.random.Generator, rate: int, duration: float) -> np.ndarray:
+    """Noise bursts separated by near silence"""
+
+    parts, length = [], 0
+
+    while length < duration * rate:
+        for scale, seconds in ((0.3, rng.uniform(0.5, 8)), (1e-4, rng.uniform(0.1, 1))):
+            parts.append(rng.normal(0, scale, int(rate * seconds)).astype(np.float32))
+            length += len(parts[-1])
+
+    return np.concatenate(parts)[: int(duration * rate)]
+
+
+def run_worker(files, output_dir, slicer, async_write, results):
+    from fish_audio_preprocess.utils.slice_audio import slice_audio_file
+    from fish_audio_preprocess.utils.slice_audio_v2 import slice_audio_file_v2
+    from fish_audio_preprocess.utils.writer import get_writer
+
+    start = time.perf_counter()
+
+    for file in files:
+        save_path = Path(output_dir) / Path(file).stem
+        save_path.mkdir(parents=True, exist_ok=True)
+
+        if slicer == "v1":
+            slice_audio_file(file, save_path, async_write=async_write)
+        else:
+            slice_audio_file_v2(file, save_path, async_write=async_write)
+
+    if async_write:
+        get_writer().flush()
+
+    results.put(
+        (
+            time.perf_counter() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        )
+    )
+
+
+@click.command()
+@click.option("--files", default=16, show_default=True, type=int)
+@click.option("--duration", default=600.0, show_default=True, type=float)
+@click.option("--rate", default=44100, show_default=True, type=int)
+@click.option("--num-workers", default=4, show_default=True, type=int)
+@click.option("--slicer", default="v1", type=click.Choice(["v1", "v2"]))
+def benchmark(files: int, duration: float, rate: int, num_workers: int, slicer: str):
+    """Compare slice assembly, then synchronous and background writes."""
+
+    rng = np.random.default_rng(0)
+    audio = synthesize(rng, rate, duration)
+    plans = list(plan_slices([(0, len(audio))], len(audio), rate, 0, 30.0, 0.4))
+    # Every slice made of two non-silent pieces and a padded silence
+    plans = [
+        [(start, start + length), (None, rate // 2), (start + length, end)]
+        for start, end in (pieces[0] for pieces in plans)
+        for length in [(end - start) // 2]
+    ]
+
+    for name, fn in [("concatenate", concatenate_pieces), ("take_pieces", take_pieces)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        for pieces in plans:
+            fn(audio, pieces)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        logger.info(
+            f"{name:>12}: {elapsed * 1000:8.1f} ms, peak {peak / 2**20:6.1f} MiB"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = []
+
+        for idx in range(files):
+            inputs.append(str(Path(tmp) / f"{idx:04d}.wav"))
+            sf.write(inputs[-1], synthesize(rng, rate, duration), rate)
+
+        # Spawned workers don't inherit the memory of this process
+        context = mp.get_context("spawn")
+
+        for async_write in (False, True):
+            results = context.Queue()
+            start = time.perf_counter()
+            workers = [
+                context.Process(
+                    target=run_worker,
+                    args=(chunk, Path(tmp) / "out", slicer, async_write, results),
+                )
+                for chunk in split_list(inputs, num_workers)
+            ]
+
+            for worker in workers:
+                worker.start()
+
+            stats = [results.get() for _ in workers]
+
+            for worker in workers:
+                worker.join()
+
+            wall = time.perf_counter() - start
+            mode = "background" if async_write else "synchronous"
+
+            for idx, (elapsed, rss) in enumerate(stats):
+                logger.info(
+                    f"{mode:>11} writes, worker {idx}: {elapsed:6.2f} s, "
+                    f"peak RSS {rss:7.1f} MiB"
+                )
+
+            logger.info(f"{mode:>11} writes, total: {wall:6.2f} s")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,436 @@
+"""Check and benchmark the slicer kernels against their reference implementations."""
+
+import importlib.util
+import time
+import tracemalloc
+
+import click
+import numpy as np
+from loguru import logger
+
+from fish_audio_preprocess.utils.energy import frame_power
+from fish_audio_preprocess.utils.kernels import (
+    KERNEL_BACKENDS,
+    flatten_slices,
+    get_backend,
+    set_backend,
+    split_by_max_duration_kernel,
+    unflatten_slices,
+)
+from fish_audio_preprocess.utils.slice_audio import (
+    plan_slices,
+    slice_pieces_by_max_duration,
+)
+from fish_audio_preprocess.utils.slice_audio_v2 import Slicer, plan_slices_v2
+
+
+def reference_sil_tags(slicer: Slicer, rms_list: np.ndarray) -> list[tuple[int, int]]:
+    """The original frame by frame loop of Slicer.slice"""
+
+    sil_tags = []
+    silence_start = None
+    clip_start = 0
+
+    for i, rms in enumerate(rms_list):
+        # Keep looping while frame is silent.
+        if rms < slicer.threshold:
+            # Record start of silent frames.
+            if silence_start is None:
+                silence_start = i
+            continue
+
+        # Keep looping while frame is not silent and silence start has not been recorded.
+        if silence_start is None:
+            continue
+
+        # Clear recorded silence start if interval is not enough or clip is too short
+        is_leading_silence = silence_start == 0 and i > slicer.max_sil_kept
+        need_slice_middle = (
+            i - silence_start >= slicer.min_interval
+            and i - clip_start >= slicer.min_length
+        )
+
+        if not is_leading_silence and not need_slice_middle:
+            silence_start = None
+            continue
+
+        # Need slicing. Record the range of silent frames to be removed.
+        if i - silence_start <= slicer.max_sil_kept:
+            pos = rms_list[silence_start : i + 1].argmin() + silence_start
+
+            if silence_start == 0:
+                sil_tags.append((0, pos))
+            else:
+                sil_tags.append((pos, pos))
+
+            clip_start = pos
+        elif i - silence_start <= slicer.max_sil_kept * 2:
+            pos = rms_list[
+                i - slicer.max_sil_kept : silence_start + slicer.max_sil_kept + 1
+            ].argmin()
+            pos += i - slicer.max_sil_kept
+            pos_l = (
+                rms_list[
+                    silence_start : silence_start + slicer.max_sil_kept + 1
+                ].argmin()
+                + silence_start
+            )
+            pos_r = (
+                rms_list[i - slicer.max_sil_kept : i + 1].argmin()
+                + i
+                - slicer.max_sil_kept
+            )
+
+            if silence_start == 0:
+                sil_tags.append((0, pos_r))
+                clip_start = pos_r
+            else:
+                sil_tags.append((min(pos_l, pos), max(pos_r, pos)))
+                clip_start = max(pos_r, pos)
+        else:
+            pos_l = (
+                rms_list[
+                    silence_start : silence_start + slicer.max_sil_kept + 1
+                ].argmin()
+                + silence_start
+            )
+            pos_r = (
+                rms_list[i - slicer.max_sil_kept : i + 1].argmin()
+                + i
+                - slicer.max_sil_kept
+            )
+
+            if silence_start == 0:
+                sil_tags.append((0, pos_r))
+            else:
+                sil_tags.append((pos_l, pos_r))
+
+            clip_start = pos_r
+        silence_start = None
+
+    # Deal with trailing silence.
+    total_frames = rms_list.shape[0]
+    if (
+        silence_start is not None
+        and total_frames - silence_start >= slicer.min_interval
+    ):
+        silence_end = min(total_frames, silence_start + slicer.max_sil_kept)
+        pos = rms_list[silence_start : silence_end + 1].argmin() + silence_start
+        sil_tags.append((pos, total_frames + 1))
+
+    return sil_tags
+
+
+def random_rms(rng: np.random.Generator, n_frames: int, threshold: float):
+    """Alternate silent and loud runs of random lengths"""
+
+    lengths = rng.geometric(rng.uniform(0.005, 0.2), size=n_frames)
+    lengths = lengths[: np.searchsorted(np.cumsum(lengths), n_frames) + 1]
+    levels = np.where(np.arange(len(lengths)) % 2 == rng.integers(2), 0.1, 10)
+    rms = np.repeat(levels, lengths)[:n_frames] * threshold
+    rms = rms * rng.uniform(0.01, 1, size=n_frames)
+
+    # Ties must resolve to the first frame, like argmin
+    return np.round(rms, 4).astype(np.float32)
+
+
+def random_slicer(rng: np.random.Generator) -> Slicer:
+    hop_size = int(rng.integers(5, 30))
+    min_interval = int(rng.integers(hop_size, 40 * hop_size))
+    min_length = int(rng.integers(min_interval, 20 * min_interval))
+    max_sil_kept = int(rng.integers(hop_size, 30 * hop_size))
+
+    return Slicer(
+        sr=1000,
+        threshold=-40,
+        min_length=min_length,
+        min_interval=min_interval,
+        hop_size=hop_size,
+        max_sil_kept=max_sil_kept,
+    )
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--trials", default=2000, show_default=True, type=int)
+@click.option("--seed", default=0, show_default=True, type=int)
+def sil_tags(trials: int, seed: int):
+    """Check Slicer._get_sil_tags against the original loop, then time both.
+
+    The vectorized numpy implementation is always checked, the numba kernel too
+    when numba is installed.
+    """
+
+    backends = [
+        backend
+        for backend in KERNEL_BACKENDS
+        if backend == "numpy" or importlib.util.find_spec(backend)
+    ]
+
+    for backend in backends:
+        set_backend(backend)
+        rng = np.random.default_rng(seed)
+
+        for trial in range(trials):
+            slicer = random_slicer(rng)
+            rms = random_rms(rng, int(rng.integers(1, 5000)), slicer.threshold)
+            expected = reference_sil_tags(slicer, rms)
+            actual = slicer._get_sil_tags(rms)
+
+            if [tuple(map(int, t)) for t in expected] != actual:
+                raise AssertionError(
+                    f"Mismatch in trial {trial} with {backend}: "
+                    f"expected {expected}, got {actual}"
+                )
+
+        logger.info(f"{trials} randomized trials of {backend} match the reference loop")
+
+    # One hour with the default 10 ms hop
+    slicer = Slicer(sr=44100, min_length=5000, min_interval=300, max_sil_kept=500)
+    rms = random_rms(rng, 360000, slicer.threshold)
+    timings = [("loop", lambda: reference_sil_tags(slicer, rms))]
+
+    for backend in backends:
+        timings.append((backend, lambda: slicer._get_sil_tags(rms)))
+
+    for name, fn in timings:
+        if name != "loop":
+            set_backend(name)
+            # The first call also compiles the numba kernel
+            fn()
+
+        start = time.perf_counter()
+        fn()
+        logger.info(f"{name:>10}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    set_backend(None)
+
+
+def measure(fn):
+    """Wall time and peak traced memory of a call"""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+@cli.command()
+@click.option("--duration", default=600.0, show_default=True, type=float)
+@click.option("--rate", default=44100, show_default=True, type=int)
+@click.option(
+    "--hop-length", "-h", multiple=True, type=int, default=[64, 256, 441, 512, 2048]
+)
+def rms(duration: float, rate: int, hop_length: list[int]):
+    """Compare frame_power with librosa.feature.rms across hop sizes."""
+
+    import librosa
+
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal(int(duration * rate)) * 0.1).astype(np.float32)
+
+    for hop in hop_length:
+        # The slicers use frames of 4 hops
+        frame = 4 * hop
+
+        # Untimed first calls, so lazy imports and compilation are not measured
+        librosa.feature.rms(y=audio[:rate], frame_length=frame, hop_length=hop)
+        frame_power(audio[:rate], frame, hop)
+
+        expected, librosa_time, librosa_peak = measure(
+            lambda: librosa.feature.rms(y=audio, frame_length=frame, hop_length=hop)[0]
+            ** 2
+        )
+        actual, kernel_time, kernel_peak = measure(
+            lambda: frame_power(audio, frame, hop)
+        )
+        error = np.max(np.abs(actual - expected) / np.maximum(expected, 1e-10))
+
+        logger.info(
+            f"hop {hop:>5}: librosa {librosa_time * 1000:8.1f} ms "
+            f"{librosa_peak / 2**20:7.1f} MiB, "
+            f"cumsum {kernel_time * 1000:8.1f} ms {kernel_peak / 2**20:7.1f} MiB, "
+            f"max relative difference {error:.1e}"
+        )
+
+
+def random_intervals(rng: np.random.Generator, n_intervals: int, rate: int):
+    """Sorted, disjoint non-silent intervals, in samples"""
+
+    bounds = np.cumsum(rng.integers(1, 10 * rate, size=2 * n_intervals))
+
+    return [(int(start), int(end)) for start, end in bounds.reshape(-1, 2)]
+
+
+def random_slices(rng: np.random.Generator, n_slices: int, rate: int):
+    """Slices of a few pieces, some of them padded silence"""
+
+    slices = []
+
+    for _ in range(n_slices):
+        pieces = []
+
+        for _ in range(int(rng.integers(1, 6))):
+            length = int(rng.integers(0, 20 * rate))
+
+            if rng.random() < 0.3:
+                pieces.append((None, length))
+            else:
+                start = int(rng.integers(0, 1000 * rate))
+                pieces.append((start, start + length))
+
+        slices.append(pieces)
+
+    return slices
+
+
+def run_backends(fn) -> dict:
+    """Result of fn with every kernel backend"""
+
+    results = {}
+
+    for backend in KERNEL_BACKENDS:
+        set_backend(backend)
+        results[backend] = fn()
+
+    set_backend(None)
+
+    return results
+
+
+def check_kernels(rng: np.random.Generator):
+    """Run one randomized case of every kernel, raise if the backends disagree"""
+
+    rate = int(rng.choice([8000, 16000, 44100]))
+    min_duration = float(rng.uniform(0, 20))
+    max_duration = float(rng.uniform(1, 40))
+    pad_silence = float(rng.uniform(0, 1))
+
+    # Slicer._get_sil_tags, also against the original loop
+    slicer = random_slicer(rng)
+    rms = random_rms(rng, int(rng.integers(1, 5000)), slicer.threshold)
+    expected = [tuple(map(int, t)) for t in reference_sil_tags(slicer, rms)]
+
+    for backend, actual in run_backends(lambda: slicer._get_sil_tags(rms)).items():
+        assert actual == expected, (backend, "sil_tags", expected, actual)
+
+    # The interval to slice assembly of plan_slices
+    # Also more intervals than a block of the numba path, fed as a stream
+    intervals = random_intervals(rng, int(rng.integers(0, 1000)), rate)
+    n_samples = intervals[-1][1] + rate if intervals else 10 * rate
+    results = run_backends(
+        lambda: list(
+            plan_slices(
+                iter(intervals),
+                n_samples,
+                rate,
+                min_duration,
+                max_duration,
+                pad_silence,
+            )
+        )
+    )
+    assert results["numpy"] == results["numba"], "plan_slices"
+
+    # slice_pieces_by_max_duration, on every slice at once
+    slices = random_slices(rng, int(rng.integers(0, 50)), rate)
+    expected = [
+        chunk
+        for pieces in slices
+        for chunk in slice_pieces_by_max_duration(pieces, max_duration, rate)
+    ]
+    actual = unflatten_slices(
+        *split_by_max_duration_kernel(*flatten_slices(slices), max_duration * rate)
+    )
+    assert actual == expected, "split_by_max_duration"
+
+    # plan_slices_v2, which uses both Slicer kernels
+    n_samples = len(rms) * slicer.hop_size
+    results = run_backends(
+        lambda: plan_slices_v2(
+            slicer, rms, n_samples, 1000, min_duration, max_duration, True
+        )
+    )
+    assert results["numpy"] == results["numba"], "plan_slices_v2"
+
+
+def time_backends(name: str, fn, repeat: int):
+    timings = {}
+
+    for backend in KERNEL_BACKENDS:
+        set_backend(backend)
+        # The first call also compiles the numba kernels
+        fn()
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        timings[backend] = (time.perf_counter() - start) / repeat
+
+    set_backend(None)
+
+    logger.info(
+        f"{name:>22}: numpy {timings['numpy'] * 1000:8.2f} ms, "
+        f"numba {timings['numba'] * 1000:8.2f} ms, "
+        f"speedup {timings['numpy'] / timings['numba']:6.1f}x"
+    )
+
+
+@cli.command()
+@click.option("--trials", default=2000, show_default=True, type=int)
+@click.option("--seed", default=0, show_default=True, type=int)
+@click.option("--repeat", default=5, show_default=True, type=int)
+def kernels(trials: int, seed: int, repeat: int):
+    """Check the numba kernels against the numpy backend, then time both."""
+
+    rng = np.random.default_rng(seed)
+
+    for trial in range(trials):
+        try:
+            check_kernels(rng)
+        except AssertionError as e:
+            raise AssertionError(f"Mismatch in trial {trial}: {e}")
+
+    logger.info(f"{trials} randomized trials match across {KERNEL_BACKENDS}")
+
+    # One hour with the default settings of both slicers
+    slicer = Slicer(sr=44100, min_length=5000, min_interval=300, max_sil_kept=500)
+    rms = random_rms(rng, 360000, slicer.threshold).astype(np.float64)
+    time_backends("Slicer._get_sil_tags", lambda: slicer._get_sil_tags(rms), repeat)
+
+    intervals = random_intervals(rng, 2000, 44100)
+    n_samples = intervals[-1][1]
+    time_backends(
+        "plan_slices",
+        lambda: list(plan_slices(intervals, n_samples, 44100, 6.0, 30.0, 0.4)),
+        repeat,
+    )
+
+    slices = random_slices(rng, 2000, 44100)
+    time_backends(
+        "split_by_max_duration",
+        lambda: (
+            unflatten_slices(
+                *split_by_max_duration_kernel(*flatten_slices(slices), 30.0 * 44100)
+            )
+            if get_backend() == "numba"
+            else [
+                chunk
+                for pieces in slices
+                for chunk in slice_pieces_by_max_duration(pieces, 30.0, 44100)
+            ]
+        ),
+        repeat,
+    )
+
+
+if __name__ == "__main__":
+    cli()